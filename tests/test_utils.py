@@ -14,6 +14,7 @@ import importlib.util
 main_module_path = Path(__file__).parent.parent / "معالج الكتب المصورة.py"
 spec = importlib.util.spec_from_file_location("main_module", main_module_path)
 main_module = importlib.util.module_from_spec(spec)
+sys.modules["main_module"] = main_module  # مطلوب لـ dataclass عند التحميل الديناميكي
 spec.loader.exec_module(main_module)
 
 # استيراد الدوال المطلوبة
@@ -21,6 +22,33 @@ list_pdfs = main_module.list_pdfs
 find_script = main_module.find_script
 extract_page_number = main_module.extract_page_number
 _find_executable = main_module._find_executable
+_tesseract_passes = main_module._tesseract_passes
+plan_batch = main_module.plan_batch
+OCRCache = main_module.OCRCache
+_page_ranges = main_module._page_ranges
+split_pnm_stream = main_module.split_pnm_stream
+StreamingPDFMerger = main_module.StreamingPDFMerger
+dedupe_pdf_resources = main_module.dedupe_pdf_resources
+merge_all_to_pdf = main_module.merge_all_to_pdf
+native_page_image = main_module.native_page_image
+choose_page_dpis = main_module.choose_page_dpis
+page_text_layer = main_module.page_text_layer
+is_blank_page = main_module.is_blank_page
+ocr_engine = main_module.ocr_engine
+ocr_split = main_module.ocr_split
+adapt_worker_limit = main_module.adapt_worker_limit
+AsyncToolRunner = main_module.AsyncToolRunner
+assemble_text = main_module.assemble_text
+normalize_arabic = main_module.normalize_arabic
+SearchIndex = main_module.SearchIndex
+index_library = main_module.index_library
+write_word_boxes = main_module.write_word_boxes
+WordBoxes = main_module.WordBoxes
+PageTextReader = main_module.PageTextReader
+LazyPDFDocument = main_module.LazyPDFDocument
+PDFSource = main_module.PDFSource
+PDFService = main_module.PDFService
+CONFIG = main_module.CONFIG
 
 
 class TestListPDFs:
@@ -95,3 +123,714 @@ class TestFindExecutable:
         result = _find_executable(["nonexistent_tool_xyz"])
         assert result is None
 
+
+
+class TestTesseractPasses:
+    """اختبارات دالة _tesseract_passes"""
+
+    def test_single_pass_when_languages_match(self, monkeypatch):
+        """اختبار تمريرة واحدة لكل الصيغ عند تطابق اللغات"""
+        monkeypatch.setitem(CONFIG, 'LANG_PDF', 'ara+eng')
+        monkeypatch.setitem(CONFIG, 'LANG_TXT', 'ara+eng')
+        monkeypatch.setitem(CONFIG, 'OCR_OUTPUTS', ['pdf', 'txt', 'tsv'])
+        assert _tesseract_passes() == [('ara+eng', ['pdf', 'txt', 'tsv'])]
+
+    def test_separate_txt_pass_when_languages_differ(self, monkeypatch):
+        """اختبار فصل تمريرة النص عند اختلاف لغته"""
+        monkeypatch.setitem(CONFIG, 'LANG_PDF', 'ara+eng')
+        monkeypatch.setitem(CONFIG, 'LANG_TXT', 'ara')
+        monkeypatch.setitem(CONFIG, 'OCR_OUTPUTS', ['pdf', 'txt'])
+        assert _tesseract_passes() == [('ara+eng', ['pdf']), ('ara', ['txt'])]
+
+
+class TestOCREngine:
+    """اختبارات دالة ocr_engine"""
+
+    def test_cli_when_forced_or_library_missing(self, monkeypatch):
+        """اختبار استعمال أمر tesseract عند طلبه أو غياب tesserocr"""
+        monkeypatch.setitem(CONFIG, 'OCR_ENGINE', 'cli')
+        assert ocr_engine() == 'cli'
+        monkeypatch.setitem(CONFIG, 'OCR_ENGINE', 'auto')
+        monkeypatch.setattr(main_module.importlib.util, 'find_spec', lambda name: None)
+        assert ocr_engine() == 'cli'
+
+    def test_api_failure_falls_back_for_one_page_only(self, monkeypatch, tmp_path):
+        """اختبار أن فشل tesserocr لصفحة لا يغيّر المحرك لبقية الصفحات"""
+        class FailingPool:
+            def submit(self, *args):
+                raise RuntimeError("no traineddata")
+        monkeypatch.setitem(CONFIG, 'OCR_ENGINE', 'auto')
+        monkeypatch.setattr(main_module, 'get_ocr_pool', lambda: FailingPool())
+        assert main_module._ocr_with_api(tmp_path / "p-0001.png", tmp_path / "p-0001", 300) is False
+        assert CONFIG['OCR_ENGINE'] == 'auto'
+
+
+class TestOCRSplit:
+    """اختبارات دالة ocr_split"""
+
+    def test_split_stays_within_budget(self):
+        """اختبار أن العمليات × الخيوط لا تتجاوز الميزانية"""
+        assert ocr_split(8, 1) == (8, 1)
+        assert ocr_split(8, 2) == (4, 2)
+        assert ocr_split(3, 2) == (1, 2)
+        assert ocr_split(2, 4) == (1, 2)
+
+    def test_candidates_are_unique(self):
+        """اختبار التقسيمات المرشحة للقياس"""
+        assert main_module._split_candidates(4) == [(4, 1), (2, 2), (1, 4)]
+
+
+class TestAdaptWorkerLimit:
+    """اختبارات دالة adapt_worker_limit"""
+
+    def test_grows_with_free_memory_and_idle_cpu(self):
+        """اختبار الزيادة عند توفر الذاكرة والمعالج"""
+        assert adapt_worker_limit(2, 2, 8000, 1.0, 8, 1, 1, 6) == 3
+        assert adapt_worker_limit(6, 6, 8000, 1.0, 8, 1, 1, 6) == 6
+
+    def test_backs_off_on_low_memory_or_high_load(self):
+        """اختبار التراجع عند نقص الذاكرة أو ارتفاع الحمل"""
+        assert adapt_worker_limit(4, 4, 300, 1.0, 8, 1, 1, 6) == 3
+        assert adapt_worker_limit(4, 4, 8000, 12.0, 8, 1, 1, 6) == 3
+        assert adapt_worker_limit(1, 1, 100, 12.0, 8, 1, 1, 6) == 1
+
+    def test_static_without_proc(self):
+        """اختبار بقاء الحد دون قراءات (يزيد حتى الحد الأعلى فقط)"""
+        assert adapt_worker_limit(3, 3, None, None, 8, 1, 1, 3) == 3
+
+    def test_limiter_starts_at_high(self):
+        """اختبار بدء البوابة من الحد الأعلى حتى لا يبطؤ أول الملف"""
+        assert main_module.AdaptiveLimiter(1, 4).limit == 4
+
+    def test_limiter_gates_asyncio_tasks(self):
+        """اختبار أن البوابة نفسها تحد مهام asyncio دون حجز خيوط"""
+        import asyncio
+        limiter = main_module.AdaptiveLimiter(1, 2)
+        running, peak = [0], [0]
+
+        async def page():
+            async with limiter:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+                await asyncio.sleep(0.01)
+                running[0] -= 1
+
+        async def main():
+            await asyncio.gather(*(page() for _ in range(6)))
+        asyncio.run(main())
+        assert peak[0] == 2 and limiter.active == 0
+
+
+class TestAsyncToolRunner:
+    """اختبارات فئة AsyncToolRunner"""
+
+    def test_returns_output_and_kills_on_timeout(self):
+        """اختبار إعادة المخرجات وإيقاف العملية بعد المهلة"""
+        import asyncio
+        import subprocess
+        import time
+
+        async def scenario():
+            runner = AsyncToolRunner({'tool': 2}, {'tool': 0.5})
+            out = await runner.run('tool', [sys.executable, '-c', 'print("ok")'])
+            start = time.monotonic()
+            with pytest.raises(subprocess.TimeoutExpired):
+                await runner.run('tool', [sys.executable, '-c', 'import time; time.sleep(30)'])
+            return out, time.monotonic() - start
+
+        out, elapsed = asyncio.run(scenario())
+        assert out.strip() == b"ok"
+        assert elapsed < 10
+
+
+class TestFallbackCommands:
+    """اختبارات دالة _fallback_commands"""
+
+    def test_uses_cheaper_settings(self, monkeypatch):
+        """اختبار أن محاولة الإعادة بلغة واحدة وPSM 3 ودقة مصغّرة عبر stdin"""
+        monkeypatch.setattr(main_module, 'TESS', 'tesseract')
+        monkeypatch.setitem(CONFIG, 'FALLBACK_SCALE', 0.5)
+        [cmd] = main_module._fallback_commands(Path("out/book-0001"), 300)
+        assert cmd[1] == 'stdin'
+        assert cmd[cmd.index('-l') + 1] == CONFIG['FALLBACK_LANG']
+        assert cmd[cmd.index('--psm') + 1] == str(CONFIG['FALLBACK_PSM'])
+        assert cmd[cmd.index('--dpi') + 1] == '150'
+
+    def test_timed_out_page_left_for_rerun(self, monkeypatch, tmp_path):
+        """اختبار حذف النواتج المبتورة للصفحة التي تجاوزت المهلة وعدم تسجيلها مكتملة"""
+        pdf = tmp_path / "book.pdf"
+        pdf.write_bytes(b"%PDF-1.4")
+        manifest = main_module.JobManifest.open(pdf, 0)
+        image = tmp_path / "book-0001.png"
+
+        def truncated(image_file, file_base, image_data, dpi):
+            for fmt in ('pdf', 'txt'):
+                image_file.with_suffix(f".{fmt}").write_bytes(b"")
+            return 'timeout'
+        monkeypatch.setitem(CONFIG, 'BLANK_DETECT', False)
+        monkeypatch.setitem(CONFIG, 'OCR_OUTPUTS', ['pdf', 'txt'])
+        monkeypatch.setattr(main_module, 'process_image_for_ocr', truncated)
+        main_module._ocr_page(image, "book", manifest)
+        assert not (tmp_path / "book-0001.pdf").exists()
+        assert manifest.page_info(1)['ocr_status'] == 'timeout'
+        assert 'ocr' not in manifest.page_info(1)
+
+
+class TestAssembleText:
+    """اختبارات دالة assemble_text"""
+
+    def test_streams_pages_without_blank_lines(self, tmp_path):
+        """اختبار الفواصل وحذف الأسطر الفارغة وإضافة سطر جديد لآخر سطر"""
+        first, second = tmp_path / "b-0002.txt", tmp_path / "b-0010.txt"
+        first.write_text("سطر أول\n\n  \nسطر ثان", encoding="utf-8")
+        second.write_text("\nنص\n\n", encoding="utf-8")
+        out = tmp_path / "b.txt"
+        assert assemble_text([(2, first), (10, second)], out) == 2
+        sep = "==============================={}===============================\n"
+        assert out.read_text(encoding="utf-8") == (sep.format(2) + "سطر أول\nسطر ثان\n" + sep.format(10) + "نص\n")
+
+
+class TestPageTextReader:
+    """اختبارات فئة PageTextReader"""
+
+    def test_reads_pages_from_offset_index(self, tmp_path):
+        """اختبار قراءة صفحة بعينها من فهرس المواضع الذي يكتبه assemble_text"""
+        first, second = tmp_path / "b-0001.txt", tmp_path / "b-0002.txt"
+        first.write_text("الصفحة الأولى\n", encoding="utf-8")
+        second.write_text("\nالثانية\nسطر\n", encoding="utf-8")
+        out = tmp_path / "b.txt"
+        assemble_text([(1, first), (2, second)], out)
+        assert (tmp_path / "b.txt.idx").exists()
+        with PageTextReader(out) as reader:
+            assert reader.pages() == [1, 2]
+            assert reader.page(2) == "الثانية\nسطر\n"
+            assert reader.page(3) is None
+
+    def test_rebuilds_stale_index(self, tmp_path):
+        """اختبار إعادة بناء الفهرس عند تغيّر ملف النص"""
+        out = tmp_path / "b.txt"
+        sep = "==============================={}===============================\n"
+        out.write_text(sep.format(7) + "سابعة\n" + sep.format(9) + "تاسعة\n", encoding="utf-8")
+        with PageTextReader(out) as reader:
+            assert reader.page(9) == "تاسعة\n"
+        out.write_text(sep.format(7) + "جديدة تماما\n", encoding="utf-8")
+        with PageTextReader(out) as reader:
+            assert reader.page(7) == "جديدة تماما\n"
+            assert reader.page(9) is None
+
+
+class TestNormalizeArabic:
+    """اختبارات دالة normalize_arabic"""
+
+    def test_folds_letters_and_strips_marks(self):
+        """اختبار توحيد الألف والياء والتاء المربوطة وحذف التشكيل والتطويل"""
+        assert normalize_arabic("إِسْلامـيّة") == "اسلاميه"
+        assert normalize_arabic("آمنَ على مستشفى") == "امن علي مستشفي"
+
+
+class TestSearchIndex:
+    """اختبارات فئة SearchIndex"""
+
+    def test_finds_pages_across_normalized_forms(self, tmp_path):
+        """اختبار العثور على الصفحات بكل الكلمات مع تجاهل التشكيل والكلمات الشائعة"""
+        sep = "==============================={}===============================\n"
+        book = tmp_path / "كتاب.txt"
+        book.write_text(sep.format(1) + "المدرسةُ الكبيرة في المدينة\n" + sep.format(2) + "مدرسة أخرى\n"
+                        + sep.format(3) + "الكبيرة وحدها\n", encoding="utf-8")
+        with SearchIndex(tmp_path / "index.sqlite") as index:
+            assert index.add_document(book) == 3
+            assert index.search("المدرسة الكبيرة") == [("كتاب", 1, 2)]
+            assert [hit[1] for hit in index.search("الكبيره")] == [1, 3]
+            assert index.search("في") == []
+            index.remove_document(book)
+            assert index.search("الكبيرة") == []
+
+    def test_incremental_update(self, tmp_path, monkeypatch):
+        """اختبار تخطي الكتب غير المتغيرة وإعادة فهرسة المتغيرة وحذف المحذوفة"""
+        sep = "===============================1===============================\n"
+        first, second = tmp_path / "أ.txt", tmp_path / "ب.txt"
+        first.write_text(sep + "قمر\n", encoding="utf-8")
+        second.write_text(sep + "شمس\n", encoding="utf-8")
+        assert index_library(tmp_path) == 2
+        added = []
+        original = SearchIndex.add_document
+        monkeypatch.setattr(SearchIndex, "add_document", lambda self, p: added.append(p.name) or original(self, p))
+        os.utime(first)  # لمس دون تغيير
+        second.write_text(sep + "نجوم\n", encoding="utf-8")
+        assert index_library(tmp_path) == 2
+        assert added == ["ب.txt"]
+        first.unlink()
+        assert index_library(tmp_path) == 1
+        with SearchIndex(tmp_path / CONFIG['INDEX_FILE']) as index:
+            assert index.search("قمر") == []
+            assert index.search("نجوم") == [("ب", 1, 1)]
+
+
+class TestWordBoxes:
+    """اختبارات write_word_boxes وWordBoxes"""
+
+    def test_round_trip_in_pdf_points(self, tmp_path):
+        """اختبار حفظ مواضع الكلمات وإعادتها بنقاط PDF"""
+        header = "level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext\n"
+        tsv = tmp_path / "b-0003.tsv"
+        tsv.write_text(header + "1\t1\t0\t0\t0\t0\t0\t0\t720\t1440\t-1\t\n"
+                       "5\t1\t1\t1\t1\t1\t72\t144\t144\t36\t96\tالمكتبةُ،\n"
+                       "5\t1\t1\t1\t1\t2\t300\t144\t72\t36\t95\tكبيرة\n", encoding="utf-8")
+        out = tmp_path / "b.words.bin"
+        assert write_word_boxes([(3, tsv, 144)], out) == 2
+        boxes = WordBoxes(out)
+        assert boxes.word(0) == "المكتبه"
+        assert boxes.find(3, ["المكتبه"]) == [(36.0, 630.0, 108.0, 648.0)]
+        assert boxes.find(4, ["المكتبه"]) == []
+
+    def test_text_batch_keeps_pdf_for_boxes(self, monkeypatch, tmp_path):
+        """اختبار مسار التحويل إلى نص كاملًا: نتيجة البحث لها مستطيل وملف PDF تشير إليه موجود"""
+        from PIL import Image
+        Image.new("L", (200, 300), 255).save(tmp_path / "book.pdf", resolution=100)
+
+        def render(pdf_file, folder_path, file_name, pages, dpis=None):
+            images = [folder_path / f"{file_name}-{n:04d}.png" for n in pages]
+            for img in images:
+                Image.new("L", (200, 300), 255).save(img)
+            return images
+
+        def ocr(image_file, file_base, image_data=None, dpi=None):
+            out_base = image_file.with_suffix('')
+            with Image.open(image_file) as im:
+                im.save(f"{out_base}.pdf", "PDF", resolution=dpi or 100)
+            Path(f"{out_base}.txt").write_text("المكتبة كبيرة\n", encoding="utf-8")
+            Path(f"{out_base}.tsv").write_text(
+                "level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext\n"
+                "5\t1\t1\t1\t1\t1\t20\t40\t60\t20\t96\tالمكتبة\n", encoding="utf-8")
+            return 'ok'
+        monkeypatch.setattr(main_module, 'TESS', 'tesseract')
+        monkeypatch.setattr(main_module, 'rasterize_pages_parallel', render)
+        monkeypatch.setattr(main_module, 'process_image_for_ocr', ocr)
+        for key, value in (('CACHE_DIR', ''), ('TEXT_LAYER', False), ('NATIVE_IMAGES', False), ('AUTO_DPI', False),
+                           ('BLANK_DETECT', False), ('PIPELINE', False), ('IN_MEMORY', False),
+                           ('ASYNC_RUNNER', False), ('OCR_TUNE', False), ('DOC_WORKERS', 1),
+                           ('OCR_OUTPUTS', ['pdf', 'txt', 'tsv'])):
+            monkeypatch.setitem(CONFIG, key, value)
+        main_module._run_ocr_batch(tmp_path, keep='txt')
+        [(name, page, box)] = main_module.search_with_boxes(tmp_path, "المكتبة")
+        assert (name, page) == ("book", 1) and box
+        assert (tmp_path / f"{name}-قابل_للبحث.pdf").exists()
+
+
+class TestPlanBatch:
+    """اختبارات دالة plan_batch"""
+
+    def test_many_documents_share_budget(self, monkeypatch):
+        """اختبار توزيع الميزانية على عدة ملفات متزامنة"""
+        monkeypatch.setitem(CONFIG, 'WORKER_BUDGET', 64)
+        monkeypatch.setitem(CONFIG, 'MAX_WORKERS', 4)
+        monkeypatch.setitem(CONFIG, 'DOC_WORKERS', 0)
+        assert plan_batch(300) == (16, 4)
+
+    def test_few_documents_get_whole_budget(self, monkeypatch):
+        """اختبار منح الميزانية كاملة عند قلة الملفات"""
+        monkeypatch.setitem(CONFIG, 'WORKER_BUDGET', 64)
+        monkeypatch.setitem(CONFIG, 'MAX_WORKERS', 4)
+        monkeypatch.setitem(CONFIG, 'DOC_WORKERS', 0)
+        assert plan_batch(2) == (2, 32)
+
+    def test_document_job_restores_config(self, monkeypatch, tmp_path):
+        """اختبار عدم بقاء خيوط الملف الواحد في CONFIG بعد انتهاء مهمته في العملية نفسها"""
+        monkeypatch.setitem(CONFIG, 'MAX_WORKERS', 4)
+        seen = []
+        monkeypatch.setattr(main_module, "process_pdf", lambda pdf, epoch: seen.append(CONFIG['MAX_WORKERS']))
+        main_module._ocr_document_job(tmp_path / "book.pdf", 0, 'txt', {'MAX_WORKERS': 32})
+        assert seen == [32]
+        assert CONFIG['MAX_WORKERS'] == 4
+
+
+class TestOCRCache:
+    """اختبارات ذاكرة OCR الدائمة"""
+
+    def test_put_then_get_restores_outputs(self, tmp_path):
+        """اختبار استرجاع نواتج صفحة مخزنة"""
+        cache = OCRCache(tmp_path / "cache", 1024 * 1024)
+        (tmp_path / "page-0001.txt").write_text("نص", encoding="utf-8")
+        (tmp_path / "page-0001.pdf").write_bytes(b"%PDF")
+        key = cache.make_key(b"image-bytes")
+        cache.put(key, tmp_path / "page-0001", ["pdf", "txt"])
+
+        out_dir = tmp_path / "out"
+        out_dir.mkdir()
+        assert cache.get(key, out_dir / "page-0007")
+        assert (out_dir / "page-0007.txt").read_text(encoding="utf-8") == "نص"
+        assert (out_dir / "page-0007.pdf").read_bytes() == b"%PDF"
+        assert not cache.get(cache.make_key(b"other"), out_dir / "page-0008")
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """اختبار حذف الأقدم استخدامًا عند تجاوز الحجم"""
+        cache = OCRCache(tmp_path / "cache", 150)
+        keys = []
+        for i in range(3):
+            (tmp_path / f"p{i}.txt").write_bytes(b"x" * 60)
+            keys.append(cache.make_key(bytes([i])))
+            cache.put(keys[-1], tmp_path / f"p{i}", ["txt"])
+        assert not cache.get(keys[0], tmp_path / "r0")
+        assert cache.get(keys[2], tmp_path / "r2")
+
+
+class TestPageRanges:
+    """اختبارات دالة _page_ranges"""
+
+    def test_groups_contiguous_pages(self):
+        """اختبار تجميع الصفحات المتصلة في نطاقات"""
+        assert _page_ranges([1, 2, 3, 7, 9, 10]) == [(1, 3), (7, 7), (9, 10)]
+
+    def test_respects_max_length(self):
+        """اختبار تقسيم النطاقات حسب الحد الأقصى"""
+        assert _page_ranges(range(1, 11), 4) == [(1, 4), (5, 8), (9, 10)]
+
+    def test_splits_on_dpi_change(self):
+        """اختبار فصل النطاق عند تغيّر دقة الصفحات"""
+        dpis = {1: 300, 2: 300, 3: 200, 4: 200}
+        assert _page_ranges([1, 2, 3, 4], dpis=dpis) == [(1, 2), (3, 4)]
+
+
+class TestSplitPNMStream:
+    """اختبارات دالة split_pnm_stream"""
+
+    def test_splits_concatenated_frames(self):
+        """اختبار فصل صور PGM متتالية"""
+        frame1 = b"P5\n2 2\n255\n" + bytes([0, 255, 255, 0])
+        frame2 = b"P5\n# comment\n3 1\n255\n" + bytes([1, 2, 3])
+        assert split_pnm_stream(frame1 + frame2) == [frame1, frame2]
+
+    def test_rejects_unknown_format(self):
+        """اختبار رفض تنسيق غير مدعوم"""
+        with pytest.raises(ValueError):
+            split_pnm_stream(b"GIF89a")
+
+
+class TestOCRPagesPipelined:
+    """اختبارات مسار التحويل وOCR المتوازيين عبر الطابور"""
+
+    def test_page_error_does_not_stall_pipeline(self, monkeypatch, tmp_path):
+        """اختبار استمرار المستهلك بعد خطأ صفحة وتسجيلها فاشلة بدل تعليق المنتج"""
+        pdf = tmp_path / "book.pdf"
+        pdf.write_bytes(b"%PDF-1.4")
+        manifest = main_module.JobManifest.open(pdf, 0)
+        folder = manifest.folder
+        folder.mkdir()
+
+        def render(pdf_file, folder_path, file_name, first, last, backend=None, density=None):
+            images = [folder_path / f"{file_name}-{n:04d}.png" for n in range(first, last + 1)]
+            for img in images:
+                img.write_bytes(b"png")
+            return 'magick', images
+
+        def ocr(image_file, file_base, image_data, dpi):
+            if image_file.name.endswith("0002.png"):
+                raise OSError("disk full")
+            image_file.with_suffix(".txt").write_text("نص", encoding="utf-8")
+            return 'ok'
+        monkeypatch.setattr(main_module, 'rasterize_pdf', render)
+        monkeypatch.setattr(main_module, 'process_image_for_ocr', ocr)
+        for key, value in (('MAX_WORKERS', 1), ('ADAPTIVE_WORKERS', False), ('PIPELINE_QUEUE', 1),
+                           ('PIPELINE_CHUNK', 1), ('IN_MEMORY', False), ('BLANK_DETECT', False),
+                           ('OCR_OUTPUTS', ['txt'])):
+            monkeypatch.setitem(CONFIG, key, value)
+        assert main_module._ocr_pages_pipelined(pdf, folder, "book", [], [1, 2, 3, 4], manifest) == 4
+        assert manifest.page_info(2)['ocr_status'] == 'error'
+        assert all('ocr' in manifest.page_info(n) for n in (1, 3, 4))
+
+
+class TestOCRDocumentAsync:
+    """اختبارات مسار asyncio لتحويل الصفحات وOCR"""
+
+    def test_failed_render_range_marks_pages_failed(self, monkeypatch, tmp_path):
+        """اختبار تسجيل صفحات النطاق الذي فشل تحويله فاشلة بدل إسقاطها بصمت"""
+        import asyncio
+        import subprocess
+        pdf = tmp_path / "book.pdf"
+        pdf.write_bytes(b"%PDF-1.4")
+        manifest = main_module.JobManifest.open(pdf, 0)
+        folder = manifest.folder
+        folder.mkdir()
+
+        async def render(runner, pdf_file, folder_path, file_name, first, last, density=None):
+            if first <= 3 <= last:
+                raise subprocess.CalledProcessError(1, ['pdftoppm'])
+            images = [folder_path / f"{file_name}-{n:04d}.png" for n in range(first, last + 1)]
+            for img in images:
+                img.write_bytes(b"png")
+            return images
+
+        async def ocr(runner, image_file, dpi=None):
+            image_file.with_suffix(".txt").write_text("نص", encoding="utf-8")
+            return 'ok'
+        monkeypatch.setattr(main_module, 'rasterize_pdf_async', render)
+        monkeypatch.setattr(main_module, 'process_image_for_ocr_async', ocr)
+        for key, value in (('MAX_WORKERS', 2), ('ADAPTIVE_WORKERS', False), ('PIPELINE_CHUNK', 2),
+                           ('BLANK_DETECT', False), ('OCR_OUTPUTS', ['txt'])):
+            monkeypatch.setitem(CONFIG, key, value)
+        done = asyncio.run(main_module._ocr_document_async(pdf, folder, "book", [], [1, 2, 3, 4, 5], manifest))
+        assert done == 3
+        assert manifest.count_pages(ocr_status='error') == 2
+        assert manifest.page_info(3)['ocr_status'] == 'error'
+
+
+class TestRasterizeToMemory:
+    """اختبارات دالة rasterize_to_memory"""
+
+    def test_rejects_missing_frames(self, monkeypatch):
+        """اختبار رفض ناتج ImageMagick إذا نقص عدد الصفحات بدل ترقيمها خطأً"""
+        import subprocess
+        frame = b"P5\n1 1\n255\n" + bytes([0])
+        monkeypatch.setattr(main_module, "MAGICK", "magick")
+        monkeypatch.setattr(main_module.subprocess, "run",
+                            lambda cmd, **kw: subprocess.CompletedProcess(cmd, 0, frame, b""))
+        with pytest.raises(ValueError):
+            main_module.rasterize_to_memory(Path("book.pdf"), 3, 4, "magick")
+
+
+class TestStreamingPDFMerger:
+    """اختبارات الدمج المتدفق لملفات PDF"""
+
+    def test_merges_pages_and_shares_identical_streams(self, tmp_path):
+        """اختبار دمج الصفحات بالترتيب ومشاركة الموارد المتطابقة"""
+        from PIL import Image
+        from PyPDF2 import PdfReader
+        paths = []
+        for i in range(4):
+            p = tmp_path / f"page-{i:04d}.pdf"
+            Image.new("RGB", (40, 60 + 10 * (i % 2)), (255, 255, 255)).save(p, resolution=72)
+            paths.append(p)
+        out = tmp_path / "merged.pdf"
+        with StreamingPDFMerger(out) as merger:
+            for p in paths:
+                merger.append(p)
+        assert merger.shared_objects > 0
+        reader = PdfReader(str(out))
+        assert [float(pg.mediabox.height) for pg in reader.pages] == [60, 70, 60, 70]
+
+    def test_dedupe_shrinks_merged_file(self, tmp_path):
+        """اختبار تقليص ملف مدمج يحتوي موارد مكررة"""
+        from PIL import Image
+        from PyPDF2 import PdfMerger, PdfReader
+        merger = PdfMerger()
+        for i in range(3):
+            p = tmp_path / f"{i}.pdf"
+            Image.new("RGB", (80, 80), (10, 20, 30)).save(p)
+            merger.append(str(p))
+        book = tmp_path / "book.pdf"
+        merger.write(str(book))
+        before = book.stat().st_size
+        _, shared = dedupe_pdf_resources(book)
+        assert shared > 0
+        assert book.stat().st_size < before
+        assert len(PdfReader(str(book)).pages) == 3
+
+    def test_dedupe_keeps_outline_and_metadata(self, tmp_path):
+        """اختبار بقاء فهرس المحتويات ومعلومات الوثيقة بعد إعادة الكتابة"""
+        from PIL import Image
+        from PyPDF2 import PdfReader, PdfWriter
+        writer = PdfWriter()
+        for i in range(3):
+            p = tmp_path / f"{i}.pdf"
+            Image.new("RGB", (80, 80), (10, 20, 30)).save(p)
+            writer.add_page(PdfReader(str(p)).pages[0])
+        writer.add_outline_item("الفصل الثاني", 1)
+        writer.add_metadata({"/Title": "كتاب"})
+        book = tmp_path / "book.pdf"
+        with open(book, "wb") as f:
+            writer.write(f)
+        before = book.stat().st_size
+        dedupe_pdf_resources(book)
+        assert book.stat().st_size < before
+        reader = PdfReader(str(book))
+        assert reader.metadata.title == "كتاب"
+        [item] = reader.outline
+        assert item.title == "الفصل الثاني"
+        assert reader.get_destination_page_number(item) == 1
+
+
+def _nested_pdf(path):
+    """ينشئ PDF بشجرة صفحات متداخلة وأبعاد موروثة من عقد /Pages."""
+    bodies = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R 4 0 R] /Count 4 /MediaBox [0 0 100 200] >>",
+        b"<< /Type /Pages /Parent 2 0 R /Kids [5 0 R 6 0 R] /Count 2 >>",
+        b"<< /Type /Pages /Parent 2 0 R /Kids [7 0 R 8 0 R] /Count 2 /MediaBox [0 0 300 400] >>",
+    ]
+    annots = {0: b" /Annots [13 0 R]", 2: b" /Annots [14 0 R]"}
+    for n in range(4):
+        bodies.append(b"<< /Type /Page /Parent %d 0 R /Contents %d 0 R%s >>" % (3 + n // 2, 9 + n, annots.get(n, b"")))
+    for n in range(4):
+        data = b"%% page %d" % (n + 1)
+        bodies.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(data), data))
+    # رابط من الصفحة 1 إلى 3 ورابط عكسي منها إلى 1
+    bodies.append(b"<< /Type /Annot /Subtype /Link /Rect [0 0 10 10] /Dest [7 0 R /Fit] >>")
+    bodies.append(b"<< /Type /Annot /Subtype /Link /Rect [0 0 10 10] /Dest [5 0 R /Fit] >>")
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for num, body in enumerate(bodies, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (num, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(bodies) + 1)
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(bodies) + 1, xref)
+    path.write_bytes(bytes(out))
+
+
+class TestLazyPDFDocument:
+    """اختبارات الوثيقة الكسولة لعمليات الصفحات"""
+
+    def test_extract_copies_only_selected_pages(self, tmp_path):
+        """اختبار الاستخراج مع الخصائص الموروثة ودون نسخ محتوى الصفحات الأخرى"""
+        from PyPDF2 import PdfReader
+        _nested_pdf(tmp_path / "book.pdf")
+        doc = LazyPDFDocument(PDFSource(tmp_path / "book.pdf"))
+        doc.load()
+        assert doc.total_pages == 4
+        out = PDFService(tmp_path).extract_pages("2-3")
+        reader = PdfReader(str(out))
+        assert [float(pg.mediabox.height) for pg in reader.pages] == [200, 400]
+        assert reader.pages[1].get_contents().get_data() == b"% page 3"
+        data = out.read_bytes()
+        assert b"% page 1" not in data and b"% page 4" not in data
+
+    def test_pages_follow_requested_order(self, tmp_path):
+        """اختبار جمع الصفحات بمسح واحد مع إعادتها بالترتيب المطلوب"""
+        _nested_pdf(tmp_path / "book.pdf")
+        doc = LazyPDFDocument(PDFSource(tmp_path / "book.pdf"))
+        doc.load()
+        pages = doc.pages([3, 0, 2])
+        assert [page["/Contents"].get_data() for page, _ in pages] == [b"% page 4", b"% page 1", b"% page 3"]
+        assert [float(page["/MediaBox"][3]) for page, _ in pages] == [400, 200, 400]
+
+    def test_links_between_selected_pages_survive(self, tmp_path):
+        """اختبار بقاء الروابط الأمامية والخلفية بين الصفحات المستخرجة، وnull لصفحة غير مستخرجة"""
+        from PyPDF2 import PdfReader
+        from PyPDF2.generic import NullObject
+        _nested_pdf(tmp_path / "book.pdf")
+        reader = PdfReader(str(PDFService(tmp_path).extract_pages("1-3")))
+        first, third = reader.pages[0], reader.pages[2]
+        assert first["/Annots"][0].get_object()["/Dest"][0].get_object() == third
+        assert third["/Annots"][0].get_object()["/Dest"][0].get_object() == first
+        reader = PdfReader(str(PDFService(tmp_path).extract_pages("1-2")))
+        assert isinstance(reader.pages[0]["/Annots"][0].get_object()["/Dest"][0], NullObject)
+
+
+class TestMergeAllToPDF:
+    """اختبارات دمج الصور في ملف PDF واحد"""
+
+    def test_jpeg_embedded_without_reencoding(self, tmp_path):
+        """اختبار تضمين JPEG كما هو مع الحفاظ على ترتيب الصفحات"""
+        from PIL import Image
+        from PyPDF2 import PdfReader
+        Image.new("RGB", (300, 150), (200, 10, 10)).save(tmp_path / "1.jpg")
+        Image.new("RGBA", (60, 60), (0, 0, 0, 0)).save(tmp_path / "2.png")
+        merge_all_to_pdf(tmp_path, out_name="out.pdf")
+        reader = PdfReader(str(tmp_path / "out.pdf"))
+        assert len(reader.pages) == 2
+        assert reader.pages[0].images[0].data == (tmp_path / "1.jpg").read_bytes()
+        assert float(reader.pages[0].mediabox.width) == 72.0
+
+
+class TestChoosePageDpis:
+    """اختبارات دالة choose_page_dpis"""
+
+    def test_uses_clamped_native_resolution(self, tmp_path):
+        """اختبار اعتماد دقة الصورة المضمّنة ضمن الحدود"""
+        from PIL import Image
+        low, high = tmp_path / "low.pdf", tmp_path / "high.pdf"
+        Image.new("L", (500, 700), 255).save(low, resolution=250)
+        Image.new("L", (1200, 1600), 255).save(high, resolution=600)
+        assert choose_page_dpis(low, [1]) == {1: 250}
+        assert choose_page_dpis(high, [1]) == {1: CONFIG['DPI_MAX']}
+
+    def test_rotation_does_not_swap_page_size(self, tmp_path):
+        """اختبار أن /Rotate لا يغيّر تقدير الدقة لأن الصورة توضع في فضاء الصفحة قبل التدوير"""
+        from PIL import Image
+        from PyPDF2 import PdfReader
+        from PyPDF2.generic import NameObject, NumberObject
+        pdf = tmp_path / "rotated.pdf"
+        Image.new("L", (500, 700), 255).save(pdf, resolution=250)
+        page = PdfReader(str(pdf)).pages[0]
+        page[NameObject("/Rotate")] = NumberObject(90)
+        assert main_module.page_image_dpi(page) == 250
+
+
+def _text_page(text):
+    """ينشئ صفحة PDF بخط Helvetica تحتوي النص المعطى."""
+    from PyPDF2 import PdfWriter
+    from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+    writer = PdfWriter()
+    page = writer.add_blank_page(612, 792)
+    font = DictionaryObject({NameObject("/Type"): NameObject("/Font"), NameObject("/Subtype"): NameObject("/Type1"),
+                             NameObject("/BaseFont"): NameObject("/Helvetica")})
+    page[NameObject("/Resources")] = DictionaryObject({
+        NameObject("/Font"): DictionaryObject({NameObject("/F1"): writer._add_object(font)})})
+    content = DecodedStreamObject()
+    content.set_data(f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode("latin-1"))
+    page[NameObject("/Contents")] = writer._add_object(content)
+    return page
+
+
+class TestPageTextLayer:
+    """اختبارات دالة page_text_layer"""
+
+    def test_accepts_real_text(self):
+        """اختبار قبول صفحة فيها نص كافٍ"""
+        text = page_text_layer(_text_page("This page was typeset and already carries a usable text layer"))
+        assert "usable text layer" in text
+
+    def test_rejects_short_or_garbled_text(self):
+        """اختبار رفض النص القصير أو المكوّن من رموز"""
+        assert page_text_layer(_text_page("Page 12")) is None
+        assert page_text_layer(_text_page("#$%&*+<=>@ " * 8)) is None
+
+
+class TestIsBlankPage:
+    """اختبارات دالة is_blank_page"""
+
+    def test_detects_blank_and_text_pages(self, tmp_path):
+        """اختبار التمييز بين صفحة فارغة بحواف داكنة وصفحة فيها سطور"""
+        from PIL import Image, ImageDraw
+        blank, text = tmp_path / "blank.png", tmp_path / "text.png"
+        im = Image.new("L", (1700, 2200), 245)
+        ImageDraw.Draw(im).rectangle([0, 0, 40, 2200], fill=0)  # ظل التجليد في الهامش
+        im.save(blank)
+        draw = ImageDraw.Draw(im)
+        for y in range(400, 700, 30):
+            draw.line([(200, y), (1500, y)], fill=0, width=3)
+        im.save(text)
+        assert is_blank_page(blank)
+        assert not is_blank_page(text)
+
+
+class TestNativePageImage:
+    """اختبارات دالة native_page_image"""
+
+    def test_single_jpeg_page_returns_original_bytes(self, tmp_path):
+        """اختبار إعادة JPEG الأصلي ودقته لصفحة ممسوحة"""
+        from PIL import Image
+        from PyPDF2 import PdfReader
+        pdf = tmp_path / "scan.pdf"
+        Image.new("RGB", (850, 1100), (255, 255, 255)).save(pdf, resolution=100)
+        suffix, data, dpi = native_page_image(PdfReader(str(pdf)).pages[0])
+        assert suffix == ".jpg"
+        assert dpi == 100
+        assert data.startswith(b"\xff\xd8")
+
+    def test_ccitt_page_keeps_black_pixels(self, tmp_path):
+        """اختبار تغليف CCITT في TIFF مع الحفاظ على الألوان"""
+        import io
+        from PIL import Image, ImageDraw
+        from PyPDF2 import PdfReader
+        pdf = tmp_path / "bw.pdf"
+        im = Image.new("1", (800, 1000), 1)
+        ImageDraw.Draw(im).rectangle([0, 0, 400, 100], fill=0)
+        im.save(pdf, resolution=100)
+        suffix, data, dpi = native_page_image(PdfReader(str(pdf)).pages[0])
+        tiff = Image.open(io.BytesIO(data)).convert("L")
+        assert suffix == ".tiff"
+        assert tiff.getpixel((10, 10)) == 0
+        assert tiff.getpixel((700, 900)) == 255
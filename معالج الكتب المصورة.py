@@ -5,12 +5,29 @@ import time
 import calendar
 import sys
 import traceback
+import atexit
+import asyncio
 import os
 import shutil
+import tempfile
 from PyPDF2 import PdfMerger, PdfReader, PdfWriter
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, EncodedStreamObject,
+                            FloatObject, IndirectObject, NameObject, NullObject, NumberObject, StreamObject)
+import io
+import struct
+import array
+import mmap
 import subprocess
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import re
+import unicodedata
+import queue
+import threading
+import hashlib
+import bisect
+import json
+import sqlite3
 from dataclasses import dataclass
 from typing import Tuple, Optional, List, Iterable
 from PIL import Image, ImageOps
@@ -52,11 +69,53 @@ PDFTOPPM: Optional[str] = _find_executable(["pdftoppm"]) # Poppler
 CONFIG = {
     'DENSITY': 400,       # dpi
     'MAX_WORKERS': 4,     # عدد خيوط OCR
+    'OCR_THREADS': 1,     # خيوط OpenMP لكل عملية tesseract (OMP_THREAD_LIMIT)؛ العمليات = MAX_WORKERS // OCR_THREADS
+    'ADAPTIVE_WORKERS': True,  # تكييف عدد صفحات OCR المتزامنة حسب الذاكرة المتاحة والحمل (من /proc)
+    'WORKERS_MIN': 1,     # أدنى عدد صفحات OCR متزامنة عند التكييف
+    'MEM_PER_WORKER_MB': 600,  # ذاكرة تقديرية لكل عملية tesseract (400 dpi على صفحات عربية كثيفة)
+    'MEM_RESERVE_MB': 512,     # ذاكرة تُترك للنظام قبل التراجع لتجنب قاتل OOM
+    'OCR_TUNE': False,    # قياس عدة تقسيمات (عمليات × خيوط) على صفحات من الملف واختيار الأسرع
+    'OCR_TUNE_PAGES': 0,  # عدد صفحات القياس (0 = بعدد خيوط الميزانية)
     'PSM': 6,             # 6 = صفحة نص متجانس
+    'OEM': 1,             # 1 = محرك LSTM
     'LANG_PDF': 'ara+eng',# لغات OCR لملف PDF
     'LANG_TXT': 'ara+eng',# لغات OCR لملف TXT
     'KEEP_IMAGES': False, # الاحتفاظ بالصور المؤقتة
     'MERGE_BATCH': 200,   # دمج PDF على دفعات
+    'OCR_OUTPUTS': ['pdf', 'txt', 'tsv'], # صيغ إخراج Tesseract من تمريرة واحدة ('tsv' لمواضع الكلمات، ويمكن إضافة 'hocr')
+    'PIPELINE': False,    # تحويل الصفحات على دفعات وتمريرها مباشرة إلى OCR بدل تحويل الكتاب كله أولًا
+    'PIPELINE_CHUNK': 8,  # عدد الصفحات في كل دفعة تحويل
+    'PIPELINE_QUEUE': 8,  # أقصى عدد صفحات تنتظر OCR على القرص
+    'ASYNC_RUNNER': False,# جدولة التحويل وOCR من حلقة asyncio واحدة بدل خيط لكل عملية خارجية
+    'TOOL_TIMEOUTS': {'magick': 1800, 'pdftoppm': 1800, 'tesseract': 600},  # مهلة كل عملية بالثواني (0 = بلا مهلة)
+    'OCR_RETRY': True,    # إعادة الصفحة التي تتجاوز مهلة tesseract بإعدادات أخف بدل تركها بلا نص
+    'FALLBACK_PSM': 3,    # تقسيم الصفحة التلقائي في محاولة الإعادة
+    'FALLBACK_LANG': 'ara',    # لغة واحدة في محاولة الإعادة ('' = نفس LANG_PDF)
+    'FALLBACK_SCALE': 0.5,     # تصغير الصورة في محاولة الإعادة
+    'RASTER_WORKERS': 0,  # عمليات تحويل متزامنة لنطاقات الصفحات (0 = نفس MAX_WORKERS)
+    'AUTO_DPI': True,     # اختيار دقة التحويل لكل صفحة من دقة صورها المضمّنة بدل DENSITY الثابتة
+    'DPI_MIN': 200,       # أدنى دقة عند الاختيار التلقائي
+    'DPI_MAX': 400,       # أعلى دقة عند الاختيار التلقائي
+    'TEXT_LAYER': True,   # نسخ نص الصفحات التي تحتوي طبقة نص حقيقية بدل تشغيل OCR عليها
+    'TEXT_LAYER_MIN_CHARS': 40,   # أقل عدد أحرف (دون المسافات) لاعتبار الصفحة نصية
+    'TEXT_LAYER_MIN_RATIO': 0.7,  # أقل نسبة لأحرف عربية/لاتينية بين الأحرف، لاستبعاد النص المشوّه
+    'BLANK_DETECT': True, # تخطّي Tesseract للصفحات الفارغة (نسبة الحبر أقل من BLANK_INK_RATIO)
+    'BLANK_INK_RATIO': 0.0003, # أعلى نسبة بكسلات داكنة لاعتبار الصفحة فارغة (سطر نص واحد ≈ 0.0015)
+    'BLANK_DARK_LEVEL': 128,   # البكسل الأغمق من هذا المستوى (0-255) يُعد حبرًا
+    'BLANK_MARGIN': 0.05,      # نسبة الهوامش المقصوصة من كل جانب قبل القياس (ظلال الحواف والتجليد)
+    'NATIVE_IMAGES': True,# تمرير صورة الصفحة المضمّنة (JPEG/CCITT/...) مباشرة إلى OCR بدل إعادة تحويلها
+    'IN_MEMORY': False,   # تحويل الصفحات إلى PGM في الذاكرة وتمريرها إلى Tesseract عبر stdin (يفعّل PIPELINE)
+    'WORKER_BUDGET': 0,   # ميزانية الخيوط الكلية لكل الملفات معًا (0 = عدد أنوية الجهاز)
+    'DOC_WORKERS': 0,     # عدد الملفات المعالجة في وقت واحد بعمليات منفصلة (0 = تلقائي)
+    'CACHE_DIR': str(Path.home() / ".cache" / "pdf-ocr-processor"), # ذاكرة OCR الدائمة ('' للتعطيل)
+    'OCR_ENGINE': 'auto', # 'auto' = عمليات Tesseract دائمة عبر tesserocr إن كانت مثبتة، 'cli' = أمر tesseract لكل صفحة
+    'CACHE_MAX_MB': 2048, # الحد الأقصى لحجم الذاكرة قبل حذف الأقدم استخدامًا
+    'INDEX_AFTER_OCR': True,  # فهرسة نصوص الكتب بعد التحويل إلى نص للبحث السريع
+    'INDEX_FILE': 'فهرس_البحث.sqlite',  # ملف الفهرس داخل مجلد الكتب
+    'IMAGE_DPI': 300,     # دقة صفحات PDF المنشأة من الصور
+    'IMAGE_PASSTHROUGH': True, # تضمين JPEG/JPEG2000 كما هي دون فك ترميز أو إعادة ضغط
+    'IMAGE_JPEG_QUALITY': 75,  # جودة JPEG للصور المعاد ترميزها (افتراضي Pillow نفسه)
+    'IMAGE_WORKERS': 0,   # خيوط فك/ترميز الصور عند الدمج (0 = تسلسلي)
 }
 
 def load_module(module_path: Path, module_name: str):
@@ -97,32 +156,455 @@ def extract_page_number(txt_file_path: str, file_base: str) -> int:
     except ValueError:
         return 0
 
-def process_image_for_ocr(image_file: Path, file_base: str):
-    """يقوم بمعالجة صورة واحدة باستخدام Tesseract لإنشاء PDF ونص."""
+def _tesseract_command(image_input: str, out_base: str, lang: str, configs: List[str],
+                       dpi: Optional[int] = None, psm: Optional[int] = None) -> List[str]:
+    """يبني أمر Tesseract واحدًا يكتب كل صيغ الإخراج المطلوبة من تمريرة تعرّف واحدة.
+    dpi يحدد دقة الصورة صراحة (لصور الصفحات الأصلية التي قد لا تحمل دقتها) فيأتي حجم صفحة PDF صحيحًا.
+    psm يتجاوز CONFIG['PSM'] (في محاولة الإعادة).
+    """
+    cmd = [TESS, image_input, out_base, '-l', lang, '--oem', str(CONFIG['OEM']), '--psm', str(psm or CONFIG['PSM'])]
+    if dpi:
+        cmd += ['--dpi', str(dpi)]
+    return cmd + list(configs)
+
+def _tesseract_passes() -> List[Tuple[str, List[str]]]:
+    """يوزّع صيغ الإخراج على تمريرات Tesseract حسب اللغة.
+    إذا تطابقت لغة PDF ولغة النص (الحالة الافتراضية) تكفي تمريرة واحدة لكل الصيغ.
+    """
+    outputs = list(dict.fromkeys(CONFIG['OCR_OUTPUTS']))  # إزالة التكرار مع حفظ الترتيب
+    if CONFIG['LANG_PDF'] == CONFIG['LANG_TXT'] or 'txt' not in outputs:
+        return [(CONFIG['LANG_PDF'], outputs)]
+    others = [c for c in outputs if c != 'txt']
+    passes = [(CONFIG['LANG_TXT'], ['txt'])]
+    if others:
+        passes.insert(0, (CONFIG['LANG_PDF'], others))
+    return passes
+
+def ocr_split(budget: Optional[int] = None, threads: Optional[int] = None) -> Tuple[int, int]:
+    """يقسم ميزانية الخيوط (MAX_WORKERS افتراضيًا) إلى (عدد عمليات tesseract، خيوط OpenMP لكل عملية)
+    حتى لا يتجاوز مجموعها عدد الأنوية؛ كل عملية تبدأ خيوطها الخاصة إن لم تُحدّد.
+    """
+    budget = max(1, budget or CONFIG['MAX_WORKERS'])
+    threads = max(1, min(threads or CONFIG['OCR_THREADS'] or 1, budget))
+    return max(1, budget // threads), threads
+
+def _ocr_env(threads: Optional[int] = None) -> dict:
+    """بيئة تشغيل tesseract مع تحديد خيوط OpenMP."""
+    env = dict(os.environ)
+    env['OMP_THREAD_LIMIT'] = str(threads or ocr_split()[1])
+    return env
+
+def ocr_settings(density: Optional[int] = None) -> dict:
+    """يعيد إعدادات OCR التي تؤثر على نواتج الصفحة (تُستعمل في مفاتيح الذاكرة وسجل المهمة)."""
+    return {
+        'lang_pdf': CONFIG['LANG_PDF'], 'lang_txt': CONFIG['LANG_TXT'],
+        'psm': CONFIG['PSM'], 'oem': CONFIG['OEM'],
+        'density': density or CONFIG['DENSITY'],
+        'outputs': sorted(set(CONFIG['OCR_OUTPUTS'])),
+    }
+
+def file_sha256(path: Path) -> str:
+    """يحسب بصمة SHA-256 لملف على أجزاء دون تحميله كاملًا في الذاكرة."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class OCRCache:
+    """ذاكرة دائمة لنتائج OCR مفهرسة ببصمة صورة الصفحة وإعدادات التعرّف.
+    الفهرس في SQLite ونواتج كل صفحة (pdf/txt/...) ملفات في blobs/، مع حذف الأقدم استخدامًا (LRU)
+    عند تجاوز الحجم الأقصى.
+    """
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.blobs = root / "blobs"
+        self.max_bytes = max_bytes
+        self.pid = os.getpid()
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(root / "index.sqlite"), timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, formats TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_access)")
+
+    @staticmethod
+    def make_key(image_bytes: bytes, density: Optional[int] = None) -> str:
+        """يحسب مفتاح الصفحة من بايتات الصورة وإعدادات OCR التي تؤثر على الناتج."""
+        h = hashlib.sha256(json.dumps(ocr_settings(density), sort_keys=True).encode('utf-8'))
+        h.update(image_bytes)
+        return h.hexdigest()
+
+    def _blob(self, key: str, fmt: str) -> Path:
+        return self.blobs / key[:2] / f"{key}.{fmt}"
+
+    def get(self, key: str, out_base: Path) -> bool:
+        """ينسخ النواتج المخزنة إلى out_base.<fmt> ويعيد True عند وجودها كاملة."""
+        with self._lock:
+            row = self._conn.execute("SELECT formats FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        try:
+            for fmt in row[0].split(","):
+                shutil.copyfile(self._blob(key, fmt), f"{out_base}.{fmt}")
+        except OSError:
+            # أُزيل الملف بين القراءة والنسخ (مثلًا بحذف من عملية أخرى): اعتبرها غير موجودة
+            return False
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return True
+
+    def put(self, key: str, out_base: Path, formats: Iterable[str]) -> None:
+        """يخزن نواتج الصفحة out_base.<fmt> ثم يطبّق حد الحجم."""
+        formats = [f for f in formats if Path(f"{out_base}.{f}").exists()]
+        if not formats:
+            return
+        size = 0
+        for fmt in formats:
+            blob = self._blob(key, fmt)
+            blob.parent.mkdir(exist_ok=True)
+            tmp = blob.with_name(f".{blob.name}.{os.getpid()}.{threading.get_ident()}")
+            shutil.copyfile(f"{out_base}.{fmt}", tmp)
+            os.replace(tmp, blob)
+            size += blob.stat().st_size
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, formats, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, ",".join(formats), size, time.time()),
+            )
+        self._evict()
+
+    def _evict(self) -> None:
+        """يحذف أقدم المدخلات استخدامًا حتى يعود الحجم الكلي تحت الحد."""
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for key, formats, size in self._conn.execute("SELECT key, formats, size FROM entries ORDER BY last_access"):
+                if total <= self.max_bytes:
+                    break
+                victims.append((key, formats))
+                total -= size
+            with self._conn:
+                self._conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k, _ in victims])
+        for key, formats in victims:
+            for fmt in formats.split(","):
+                try:
+                    self._blob(key, fmt).unlink()
+                except OSError:
+                    pass
+
+_OCR_CACHE: Optional[OCRCache] = None
+_OCR_CACHE_LOCK = threading.Lock()
+
+def get_ocr_cache() -> Optional[OCRCache]:
+    """يعيد ذاكرة OCR المشتركة للعملية الحالية، أو None إذا كانت معطلة أو تعذر فتحها."""
+    global _OCR_CACHE
+    if not CONFIG['CACHE_DIR']:
+        return None
+    with _OCR_CACHE_LOCK:
+        root = Path(CONFIG['CACHE_DIR']).expanduser()
+        # اتصال SQLite لا يُشارك بين العمليات، فأعد الفتح في العمليات الفرعية
+        if _OCR_CACHE is None or _OCR_CACHE.root != root or _OCR_CACHE.pid != os.getpid():
+            try:
+                _OCR_CACHE = OCRCache(root, int(CONFIG['CACHE_MAX_MB']) * 1024 * 1024)
+            except (OSError, sqlite3.Error) as e:
+                print(f"تعذر فتح ذاكرة OCR في {root}: {e}. المتابعة بدونها.")
+                CONFIG['CACHE_DIR'] = ''
+                return None
+        return _OCR_CACHE
+
+# عمليات OCR دائمة: كل عملية تحمّل نماذج اللغة مرة واحدة في TessBaseAPI (عبر tesserocr)
+# وتعيد استعمالها لكل الصفحات، بدل تحميلها (نحو ثانية لـ ara+eng) مع كل استدعاء لأمر tesseract.
+_TESS_APIS: dict = {}
+_TESS_SETTINGS: dict = {}
+_OCR_POOL: Optional[ProcessPoolExecutor] = None
+_OCR_POOL_PID: Optional[int] = None
+_OCR_POOL_LOCK = threading.Lock()
+
+def _tess_worker_init(psm: int, oem: int, threads: int):
+    """مهيّئ عملية OCR الدائمة: يحفظ الإعدادات ويحدد خيوط OpenMP قبل تحميل المكتبة؛
+    تُنشأ واجهات اللغات عند أول صفحة.
+    """
+    os.environ['OMP_THREAD_LIMIT'] = str(threads)
+    _TESS_SETTINGS.update(psm=psm, oem=oem)
+
+def _tess_api(lang: str):
+    """يعيد TessBaseAPI مهيّأة للغة المطلوبة، وتبقى حية طوال عمر العملية."""
+    import tesserocr  # type: ignore
+    api = _TESS_APIS.get(lang)
+    if api is None:
+        api = tesserocr.PyTessBaseAPI(lang=lang, psm=_TESS_SETTINGS['psm'], oem=_TESS_SETTINGS['oem'])
+        _TESS_APIS[lang] = api
+    return api
+
+def _tess_worker_ocr(image_file: str, out_base: str, passes: List[Tuple[str, List[str]]], dpi: Optional[int],
+                     timeout: Optional[float] = None):
+    """يعالج صفحة داخل عملية OCR دائمة ويكتب نفس نواتج أمر tesseract ({out_base}.pdf/.txt/...).
+    timeout (ثوانٍ) يوقف التعرّف من داخل Tesseract ويرفع TimeoutError.
+    """
+    for lang, configs in passes:
+        api = _tess_api(lang)
+        for fmt in ('pdf', 'txt', 'hocr', 'tsv'):
+            api.SetVariable(f"tessedit_create_{fmt}", "1" if fmt in configs else "0")
+        api.SetVariable("user_defined_dpi", str(dpi or 0))  # 0 = دقة الصورة نفسها
+        start = time.monotonic()
+        if not api.ProcessPages(out_base, image_file, timeout=int((timeout or 0) * 1000)):
+            if timeout and time.monotonic() - start >= timeout:
+                raise TimeoutError(f"تجاوز TessBaseAPI المهلة في {Path(image_file).name}")
+            raise RuntimeError(f"فشل TessBaseAPI في معالجة {Path(image_file).name}")
+
+def ocr_engine() -> str:
+    """يحدد محرك OCR المستعمل: 'api' (عمليات tesserocr دائمة) أو 'cli' (أمر tesseract لكل صفحة)."""
+    if CONFIG['OCR_ENGINE'] in ('auto', 'api') and importlib.util.find_spec("tesserocr") is not None:
+        return 'api'
+    return 'cli'
+
+def get_ocr_pool() -> ProcessPoolExecutor:
+    """يعيد مجمّع عمليات OCR الدائمة للعملية الحالية (حسب ocr_split)، وينشئه عند أول استعمال."""
+    global _OCR_POOL, _OCR_POOL_PID
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is None or _OCR_POOL_PID != os.getpid():
+            workers, threads = ocr_split()
+            _OCR_POOL = ProcessPoolExecutor(max_workers=workers, initializer=_tess_worker_init,
+                                            initargs=(CONFIG['PSM'], CONFIG['OEM'], threads))
+            _OCR_POOL_PID = os.getpid()
+        return _OCR_POOL
+
+def shutdown_ocr_pool():
+    """يغلق عمليات OCR الدائمة (عند الخروج أو بعد تعطل المجمّع)."""
+    global _OCR_POOL
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is not None and _OCR_POOL_PID == os.getpid():
+            _OCR_POOL.shutdown(wait=False)
+        _OCR_POOL = None
+
+atexit.register(shutdown_ocr_pool)
+
+def _ocr_api_failed(image_file: Path, error: Exception) -> None:
+    """يسجل فشل الواجهة الدائمة لصفحة واحدة؛ تُعاد الصفحة بأمر tesseract وتبقى بقية الصفحات على الواجهة.
+    إذا تعطل المجمّع نفسه (انهيار عملية) يُغلق ليُنشأ من جديد عند الصفحة التالية.
+    """
+    print(f"تعذر OCR عبر tesserocr للصورة {image_file.name} ({error}). الرجوع إلى أمر tesseract لهذه الصفحة.")
+    if isinstance(error, BrokenProcessPool):
+        shutdown_ocr_pool()
+
+def _ocr_with_api(image_file: Path, out_base: Path, dpi: Optional[int]) -> bool:
+    """يرسل الصفحة إلى عملية OCR دائمة. يعيد False عند الفشل فيُستعمل أمر tesseract لهذه الصفحة."""
+    try:
+        get_ocr_pool().submit(_tess_worker_ocr, str(image_file), str(out_base), _tesseract_passes(), dpi,
+                              _ocr_timeout()).result()
+        return True
+    except TimeoutError:
+        raise  # مهلة الصفحة تُعالج بمحاولة الإعادة، لا بأمر tesseract بالإعدادات نفسها
+    except Exception as e:
+        _ocr_api_failed(image_file, e)
+        return False
+
+def _ocr_timeout() -> Optional[float]:
+    """مهلة عملية tesseract الواحدة بالثواني، أو None بلا مهلة."""
+    return CONFIG['TOOL_TIMEOUTS'].get('tesseract') or None
+
+def fallback_image_bytes(image_file: Path, image_data: Optional[bytes] = None) -> bytes:
+    """نسخة PNG رمادية مصغّرة بنسبة FALLBACK_SCALE من صورة الصفحة لمحاولة الإعادة."""
+    with Image.open(io.BytesIO(image_data) if image_data is not None else image_file) as im:
+        gray = im.convert("L")
+    scale = CONFIG['FALLBACK_SCALE'] or 1
+    if scale != 1:
+        gray = gray.resize((max(1, round(gray.width * scale)), max(1, round(gray.height * scale))), Image.LANCZOS)
+    buf = io.BytesIO()
+    gray.save(buf, "PNG")
+    return buf.getvalue()
+
+def discard_ocr_outputs(out_base: Path) -> None:
+    """يحذف نواتج Tesseract للصفحة؛ Tesseract ينشئها عند البدء فتبقى فارغة أو مبتورة إذا أُوقف أو فشل."""
+    for fmt in ('pdf', 'txt', 'hocr', 'tsv'):
+        try:
+            Path(f"{out_base}.{fmt}").unlink()
+        except FileNotFoundError:
+            pass
+
+def _fallback_commands(out_base: Path, dpi: Optional[int]) -> List[List[str]]:
+    """أوامر محاولة الإعادة: تمريرة واحدة للغة واحدة بـ FALLBACK_PSM على صورة مصغّرة تُرسل عبر stdin.
+    الدقة تُصغّر بنفس النسبة فيبقى حجم صفحة PDF كما هو.
+    """
+    lang = CONFIG['FALLBACK_LANG'] or CONFIG['LANG_PDF']
+    outputs = list(dict.fromkeys(CONFIG['OCR_OUTPUTS']))
+    return [_tesseract_command('stdin', str(out_base), lang, outputs, _fallback_dpi(dpi), CONFIG['FALLBACK_PSM'])]
+
+def _fallback_dpi(dpi: Optional[int]) -> int:
+    """دقة الصورة المصغّرة في محاولة الإعادة."""
+    return max(1, round((dpi or CONFIG['DENSITY']) * (CONFIG['FALLBACK_SCALE'] or 1)))
+
+def process_image_for_ocr(image_file: Path, file_base: str, image_data: Optional[bytes] = None,
+                          dpi: Optional[int] = None) -> str:
+    """يقوم بمعالجة صورة واحدة باستخدام Tesseract لإنشاء PDF ونص (وhOCR/TSV عند طلبها) من تعرّف واحد.
+    إذا مُرّرت image_data (صورة PGM في الذاكرة) تُرسل إلى Tesseract عبر stdin ويُستعمل image_file
+    لتسمية النواتج فقط. تُستعمل ذاكرة OCR الدائمة إن كانت مفعّلة.
+    إذا تجاوز Tesseract المهلة تُوقف العملية وتُعاد الصفحة بإعدادات أخف (انظر _fallback_commands).
+    يعيد الحالة: 'ok' أو 'fallback' أو 'timeout' أو 'error'.
+    """
     try:
         if not TESS:
             print("Tesseract غير متوفر في النظام. تخطّي OCR لهذه الصورة.")
-            return
-        tesseract_pdf_command = [TESS, str(image_file), str(image_file.with_suffix('')), '-l', CONFIG['LANG_PDF'], '--oem', '1', '--psm', str(CONFIG['PSM']), 'pdf']
-        tesseract_txt_command = [TESS, str(image_file), str(image_file.with_suffix('')), '-l', CONFIG['LANG_TXT'], '--oem', '1', '--psm', str(CONFIG['PSM']), 'txt']
-        
-        subprocess.run(tesseract_pdf_command, check=True, capture_output=True, text=True)
-        subprocess.run(tesseract_txt_command, check=True, capture_output=True, text=True)
+            return 'error'
+        out_base = image_file.with_suffix('')
+        cache = get_ocr_cache()
+        key = None
+        if cache is not None:
+            key = cache.make_key(image_data if image_data is not None else image_file.read_bytes(), dpi)
+            if cache.get(key, out_base):
+                return 'ok'
+        try:
+            # الصور في الذاكرة تُرسل عبر stdin إلى الأمر؛ الواجهة الدائمة تقرأ الملفات فقط
+            if not (image_data is None and ocr_engine() == 'api' and _ocr_with_api(image_file, out_base, dpi)):
+                for lang, configs in _tesseract_passes():
+                    if image_data is None:
+                        tesseract_command = _tesseract_command(str(image_file), str(out_base), lang, configs, dpi)
+                        subprocess.run(tesseract_command, check=True, capture_output=True, text=True,
+                                       env=_ocr_env(), timeout=_ocr_timeout())
+                    else:
+                        tesseract_command = _tesseract_command('stdin', str(out_base), lang, configs, dpi)
+                        subprocess.run(tesseract_command, input=image_data, check=True, capture_output=True,
+                                       env=_ocr_env(), timeout=_ocr_timeout())
+        except (subprocess.TimeoutExpired, TimeoutError):
+            if not CONFIG['OCR_RETRY']:
+                print(f"تجاوز Tesseract المهلة ({_ocr_timeout()} ث) للصورة {image_file.name}، أُوقفت العملية.")
+                return 'timeout'
+            print(f"تجاوز Tesseract المهلة للصورة {image_file.name}. إعادة المحاولة بإعدادات أخف...")
+            discard_ocr_outputs(out_base)
+            fallback = fallback_image_bytes(image_file, image_data)
+            try:
+                for cmd in _fallback_commands(out_base, dpi):
+                    subprocess.run(cmd, input=fallback, check=True, capture_output=True,
+                                   env=_ocr_env(), timeout=_ocr_timeout())
+            except subprocess.TimeoutExpired:
+                print(f"تجاوزت محاولة الإعادة المهلة أيضًا للصورة {image_file.name}.")
+                return 'timeout'
+            return 'fallback'  # لا تُحفظ في الذاكرة: نتيجتها أضعف من الإعدادات الأصلية
+        if cache is not None and key is not None:
+            cache.put(key, out_base, CONFIG['OCR_OUTPUTS'])
+        return 'ok'
     except subprocess.CalledProcessError as e:
-        print(f"حدث خطأ في Tesseract أثناء معالجة الصورة {image_file.name}: {e.stderr}")
+        stderr = e.stderr.decode('utf-8', 'replace') if isinstance(e.stderr, bytes) else e.stderr
+        print(f"حدث خطأ في Tesseract أثناء معالجة الصورة {image_file.name}: {stderr}")
     except Exception as e:
         print(f"حدث خطأ أثناء معالجة الصورة {image_file.name}: {e}")
+    return 'error'
 
-def remove_empty_lines(file_path: Path):
-    """يزيل الأسطر الفارغة من ملف نصي."""
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        non_empty_lines = [line for line in lines if line.strip()]
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.writelines(non_empty_lines)
-    except Exception as e:
-        print(f"فشل إزالة الأسطر الفارغة من {file_path.name}: {e}")
+def assemble_text(pages: List[Tuple[int, Path]], out_path: Path) -> int:
+    """يدمج نصوص الصفحات في ملف واحد بتمريرة واحدة وذاكرة ثابتة: فاصل =====N===== قبل كل صفحة
+    وتُحذف الأسطر الفارغة أثناء الكتابة. pages أزواج (رقم الصفحة، ملف النص) مرتبة. يعيد عدد الصفحات.
+    يُكتب بجانبه فهرس المواضع {name}.txt.idx (صفحة -> نطاق البايتات) لقراءة أي صفحة مباشرة.
+    """
+    offsets: List[Tuple[int, int, int]] = []
+    with open(out_path, 'wb') as outfile:
+        for page_number, txt_file in pages:
+            outfile.write(f"==============================={page_number}===============================\n".encode('utf-8'))
+            start = outfile.tell()
+            with open(txt_file, 'r', encoding='utf-8') as infile:
+                for line in infile:
+                    if line.strip():
+                        outfile.write((line if line.endswith("\n") else line + "\n").encode('utf-8'))
+            offsets.append((page_number, start, outfile.tell()))
+    write_page_offsets(out_path, offsets)
+    return len(pages)
+
+# فهرس المواضع {name}.txt.idx: ترويسة (OCRP، الإصدار، عدد الصفحات، حجم النص ووقت تعديله للتحقق من تطابقه)
+# ثم (رقم الصفحة، بداية نصها، نهايته) لكل صفحة، بعد سطر الفاصل مباشرة.
+PAGE_INDEX_SUFFIX = ".idx"
+_PAGE_INDEX_HEADER = struct.Struct("<4sHIQQ")
+_PAGE_INDEX_ENTRY = struct.Struct("<IQQ")
+_PAGE_SEPARATOR_BYTES = re.compile(rb"^=+(\d+)=+\r?\n?$")
+
+def page_index_path(txt_path: Path) -> Path:
+    return txt_path.with_name(txt_path.name + PAGE_INDEX_SUFFIX)
+
+def write_page_offsets(txt_path: Path, offsets: List[Tuple[int, int, int]]) -> Path:
+    """يكتب فهرس المواضع لملف نص كتاب (كتابة ذرّية)."""
+    st = txt_path.stat()
+    idx_path = page_index_path(txt_path)
+    tmp = idx_path.with_name(f".{idx_path.name}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(_PAGE_INDEX_HEADER.pack(b"OCRP", 1, len(offsets), st.st_size, st.st_mtime_ns))
+        for entry in offsets:
+            f.write(_PAGE_INDEX_ENTRY.pack(*entry))
+    os.replace(tmp, idx_path)
+    return idx_path
+
+def scan_page_offsets(txt_path: Path) -> List[Tuple[int, int, int]]:
+    """يبني مواضع الصفحات بمسح ملف النص مرة واحدة (لملفات قديمة بلا فهرس أو بفهرس غير مطابق)."""
+    offsets: List[Tuple[int, int, int]] = []
+    page, start, pos = None, 0, 0
+    with open(txt_path, 'rb') as f:
+        for line in f:
+            m = _PAGE_SEPARATOR_BYTES.match(line)
+            if m:
+                if page is not None:
+                    offsets.append((page, start, pos))
+                page, start = int(m.group(1)), pos + len(line)
+            pos += len(line)
+    if page is not None:
+        offsets.append((page, start, pos))
+    return offsets
+
+class PageTextReader:
+    """قارئ صفحات ملف نص كتاب كبير: يربط الملف بالذاكرة (mmap) ويعيد نص أي صفحة مباشرة من فهرس المواضع
+    دون مسح الملف. إذا غاب الفهرس أو لم يطابق الملف يُعاد بناؤه مرة واحدة.
+    """
+
+    def __init__(self, txt_path: Path):
+        self.path = txt_path
+        self.offsets = self._load_offsets()
+        self._file = open(txt_path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets else None
+        except ValueError:  # ملف فارغ
+            self._map = None
+
+    def _load_offsets(self) -> dict:
+        st = self.path.stat()
+        idx_path = page_index_path(self.path)
+        try:
+            data = idx_path.read_bytes()
+            magic, version, count, size, mtime_ns = _PAGE_INDEX_HEADER.unpack_from(data, 0)
+            if magic == b"OCRP" and version == 1 and (size, mtime_ns) == (st.st_size, st.st_mtime_ns):
+                return {page: (start, end) for page, start, end in
+                        _PAGE_INDEX_ENTRY.iter_unpack(data[_PAGE_INDEX_HEADER.size:_PAGE_INDEX_HEADER.size + count * _PAGE_INDEX_ENTRY.size])}
+        except (OSError, struct.error):
+            pass
+        offsets = scan_page_offsets(self.path)
+        try:
+            write_page_offsets(self.path, offsets)
+        except OSError as e:
+            print(f"تعذر حفظ فهرس المواضع لـ {self.path.name}: {e}")
+        return {page: (start, end) for page, start, end in offsets}
+
+    def pages(self) -> List[int]:
+        return sorted(self.offsets)
+
+    def page(self, number: int) -> Optional[str]:
+        """نص الصفحة، أو None إذا لم تكن في الملف."""
+        span = self.offsets.get(number)
+        if span is None or self._map is None:
+            return None
+        return self._map[span[0]:span[1]].decode('utf-8')
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
 
 def merge_pdfs_in_batches(paths: List[Path], out_path: Path, batch_size: int = CONFIG['MERGE_BATCH']):
     """يدمج قائمة من ملفات PDF في دفعة واحدة للحفاظ على الذاكرة."""
@@ -152,75 +634,1392 @@ def merge_pdfs_in_batches(paths: List[Path], out_path: Path, batch_size: int = C
             except OSError as e:
                 print(f"فشل حذف الملف المؤقت {c.name}: {e}")
 
-def process_pdf(pdf_file: Path, epoch_time: int):
-    """يقوم بتحويل ملف PDF مصور إلى نص وPDF قابل للبحث."""
+class StreamingPDFMerger:
+    """يدمج صفحات ملفات PDF في ملف ناتج بتمريرة واحدة دون إعادة تحميل الملفات أو تجميعها في الذاكرة.
+    كل كائن يُنسخ مرة واحدة ويُكتب فورًا إلى الملف الناتج مع تسجيل موضعه لجدول xref في النهاية،
+    فلا يبقى في الذاكرة إلا ملف الإدخال الحالي وأرقام المواضع.
+    الكائنات المتطابقة تُكتب مرة واحدة وتُشارك بين الصفحات: لأن الأبناء يُنسخون قبل آبائهم،
+    تتطابق بصمة السلسلة كاملة (ملف الخط ← واصفه ← CIDFont ← Type0) كما في خط GlyphLessFont
+    الذي يضمّنه Tesseract في كل صفحة.
+    """
+    # أنواع لا تُشارك حتى لو تطابقت لأن لكل نسخة هوية مستقلة
+    UNSHARED_TYPES = {"/Page", "/Pages", "/Catalog", "/Annot"}
+    def __init__(self, out_path: Path):
+        self.out_path = out_path
+        self._f = open(out_path, "wb")
+        self._f.write(b"%PDF-1.5\n%\xe2\xe3\xcf\xd3\n")
+        self._offsets: List[int] = [0]  # الفهرس = رقم الكائن، والصفر غير مستخدم
+        self._catalog = self._reserve()
+        self._pages_root = self._reserve()
+        self._kids: List[int] = []
+        self._catalog_entries = DictionaryObject()  # مداخل الفهرس المنسوخة غير /Pages (انظر copy_document_entries)
+        self._info: Optional[IndirectObject] = None
+        self._shared: dict = {}  # بصمة الكائن -> رقمه في الملف الناتج
+        self.shared_objects = 0
+
+    def __enter__(self) -> "StreamingPDFMerger":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._f.close()
+
+    @property
+    def page_count(self) -> int:
+        return len(self._kids)
+
+    def _reserve(self) -> int:
+        self._offsets.append(0)
+        return len(self._offsets) - 1
+
+    def _write_raw(self, num: int, body: bytes) -> None:
+        self._offsets[num] = self._f.tell()
+        self._f.write(f"{num} 0 obj\n".encode("ascii"))
+        self._f.write(body)
+        self._f.write(b"\nendobj\n")
+
+    @staticmethod
+    def _serialize(obj) -> bytes:
+        buf = io.BytesIO()
+        obj.write_to_stream(buf, None)
+        return buf.getvalue()
+
+    def _shareable(self, obj) -> bool:
+        """الكائنات التي يُسمح بمشاركتها عند التطابق: streams والقواميس والمصفوفات غير المباشرة."""
+        if isinstance(obj, DictionaryObject):
+            return dict.get(obj, "/Type") not in self.UNSHARED_TYPES
+        return isinstance(obj, ArrayObject)
+
+    def _copy_ref(self, ref: IndirectObject, memo: dict, pending: dict) -> IndirectObject:
+        """ينسخ كائنًا غير مباشر بعد نسخ أبنائه (ترتيب لاحق) ويعيد مرجعه في الملف الناتج."""
+        key = (ref.idnum, ref.generation)
+        if key in memo:
+            return IndirectObject(memo[key], 0, None)
+        if key in pending:
+            # مرجع دائري: احجز رقمًا الآن ويُكتب الكائن تحته عند اكتماله
+            if pending[key] is None:
+                pending[key] = self._reserve()
+            return IndirectObject(pending[key], 0, None)
+        obj = ref.get_object()
+        if isinstance(obj, DictionaryObject) and dict.get(obj, "/Type") in ("/Page", "/Pages"):
+            # مرجع إلى صفحة لم تُنسخ (وجهة رابط مثلًا): نسخها يجرّ شجرة الصفحات كلها
+            return NullObject()
+        pending[key] = None
+        copied = self._copy_direct(obj, memo, pending)
+        num = pending.pop(key)
+        body = self._serialize(copied)
+        if num is None and self._shareable(copied):
+            digest = hashlib.sha256(body).digest()
+            existing = self._shared.get(digest)
+            if existing is not None:
+                memo[key] = existing
+                self.shared_objects += 1
+                return IndirectObject(existing, 0, None)
+            num = self._reserve()
+            self._shared[digest] = num
+        elif num is None:
+            num = self._reserve()
+        self._write_raw(num, body)
+        memo[key] = num
+        return IndirectObject(num, 0, None)
+
+    def _copy_direct(self, obj, memo: dict, pending: dict):
+        if isinstance(obj, IndirectObject):
+            return self._copy_ref(obj, memo, pending)
+        if isinstance(obj, StreamObject):
+            new = obj.__class__()
+            new._data = obj._data
+            for k, v in dict.items(obj):
+                if k != "/Length":
+                    new[NameObject(k)] = self._copy_direct(v, memo, pending)
+            return new
+        if isinstance(obj, DictionaryObject):
+            new_dict = DictionaryObject()
+            for k, v in dict.items(obj):
+                new_dict[NameObject(k)] = self._copy_direct(v, memo, pending)
+            return new_dict
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy_direct(v, memo, pending) for v in obj)
+        if obj is None:
+            return NullObject()
+        return obj
+
+    def append_pages(self, reader: PdfReader, indices: Optional[Iterable[int]] = None) -> dict:
+        """يضيف صفحات من قارئ مفتوح (كلها أو الفهارس المحددة) إلى الملف الناتج.
+        يعيد جدول المراجع المنسوخة (انظر append_page_objects).
+        """
+        pages = reader.pages
+        selected = (pages[i] for i in (range(len(pages)) if indices is None else indices))
+        return self.append_page_objects(
+            (page, getattr(page, "indirect_reference", None) or getattr(page, "indirect_ref", None))
+            for page in selected
+        )
+
+    def append_page_objects(self, pages: Iterable[Tuple[DictionaryObject, Optional[IndirectObject]]]) -> dict:
+        """يضيف قواميس صفحات من ملف واحد مع مراجعها؛ الموارد المشتركة بينها تُنسخ مرة واحدة.
+        تُحجز أرقام كل الصفحات قبل نسخ أي منها، فتبقى المراجع بينها (الروابط و/P في التعليقات)
+        صحيحة في الاتجاهين، ولا يصير null إلا مرجع صفحة خارج الملف الناتج.
+        يعيد جدول المراجع المنسوخة (مرجع المصدر -> رقم الكائن الناتج) لنسخ بقية الوثيقة عليه.
+        """
+        memo: dict = {}
+        pending: dict = {}
+        pages = list(pages)
+        nums = [self._reserve() for _ in pages]
+        for (page, ref), num in zip(pages, nums):
+            if ref is not None:
+                memo[(ref.idnum, ref.generation)] = num
+        for (page, ref), num in zip(pages, nums):
+            new_page = DictionaryObject()
+            for k, v in dict.items(page):
+                if k != "/Parent":
+                    new_page[NameObject(k)] = self._copy_direct(v, memo, pending)
+            new_page[NameObject("/Parent")] = IndirectObject(self._pages_root, 0, None)
+            self._write_raw(num, self._serialize(new_page))
+            self._kids.append(num)
+        return memo
+
+    def copy_document_entries(self, reader: PdfReader, memo: dict) -> None:
+        """ينسخ مداخل فهرس الوثيقة غير شجرة الصفحات (/Outlines و/Names و/PageLabels...) ومعلومات /Info،
+        على جدول المراجع الذي أعادته append_pages فتشير الوجهات إلى الصفحات المنسوخة.
+        """
+        pending: dict = {}
+        root = reader.trailer["/Root"]
+        for k, v in dict.items(root):
+            if k not in ("/Type", "/Pages"):
+                self._catalog_entries[NameObject(k)] = self._copy_direct(v, memo, pending)
+        info = dict.get(reader.trailer, "/Info")
+        if info is not None:
+            info = self._copy_direct(info, memo, pending)
+            if not isinstance(info, IndirectObject):
+                num = self._reserve()
+                self._write_raw(num, self._serialize(info))
+                info = IndirectObject(num, 0, None)
+            self._info = info
+
+    def append(self, path: Path) -> None:
+        """يضيف كل صفحات ملف PDF ثم يحرر قارئه."""
+        reader = PdfReader(str(path), strict=False)
+        if reader.is_encrypted:
+            reader.decrypt("")
+        self.append_pages(reader)
+
+    def close(self) -> None:
+        """يكتب شجرة الصفحات والفهرس وجدول xref ثم يغلق الملف."""
+        pages_root = DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(IndirectObject(k, 0, None) for k in self._kids),
+            NameObject("/Count"): NumberObject(len(self._kids)),
+        })
+        self._write_raw(self._pages_root, self._serialize(pages_root))
+        catalog = DictionaryObject(self._catalog_entries)
+        catalog.update({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(self._pages_root, 0, None),
+        })
+        self._write_raw(self._catalog, self._serialize(catalog))
+        xref_offset = self._f.tell()
+        size = len(self._offsets)
+        self._f.write(f"xref\n0 {size}\n0000000000 65535 f \n".encode("ascii"))
+        for off in self._offsets[1:]:
+            self._f.write(f"{off:010d} 00000 n \n".encode("ascii"))
+        info = f" /Info {self._info.idnum} 0 R" if self._info is not None else ""
+        self._f.write(f"trailer\n<< /Size {size} /Root {self._catalog} 0 R{info} >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+        self._f.close()
+
+def merge_pdfs_streaming(paths: List[Path], out_path: Path):
+    """يدمج ملفات PDF (صفحات Tesseract المفردة عادةً) بتمريرة واحدة عبر StreamingPDFMerger.
+    يعود إلى merge_pdfs_in_batches إذا تعذر الدمج المتدفق لملف غير مألوف.
+    """
     try:
-        file_name = pdf_file.stem
-        folder_path = pdf_file.parent / f"{epoch_time}_{file_name}_temp"
-        os.makedirs(folder_path, exist_ok=True)
+        with StreamingPDFMerger(out_path) as merger:
+            for p in paths:
+                merger.append(p)
+        if merger.shared_objects:
+            print(f"شوركت {merger.shared_objects} موارد متطابقة بين الصفحات بدل تكرارها.")
+    except Exception as e:
+        print(f"تعذر الدمج المتدفق ({e}). الرجوع إلى الدمج على دفعات...")
+        merge_pdfs_in_batches(paths, out_path)
+
+def dedupe_pdf_resources(pdf_path: Path, out_path: Optional[Path] = None) -> Tuple[Path, int]:
+    """يعيد كتابة PDF مع مشاركة الموارد المكررة (الخطوط ووصفاتها والصور المتطابقة) بنسخة واحدة.
+    مناسب لملفات قابل_للبحث المؤرشفة التي دُمجت بدون مشاركة. تُحفظ الصفحات ومداخل الفهرس
+    (فهرس المحتويات والأسماء وتسميات الصفحات...) ومعلومات الوثيقة.
+    إذا لم يُحدد out_path يُستبدل الملف الأصلي فقط عندما يصغر حجمه. يعيد (المسار، عدد الكائنات المشتركة).
+    """
+    target = out_path or pdf_path.with_name(f".{pdf_path.stem}.dedupe.pdf")
+    reader = PdfReader(str(pdf_path), strict=False)
+    if reader.is_encrypted:
+        reader.decrypt("")
+    try:
+        with StreamingPDFMerger(target) as merger:
+            memo = merger.append_pages(reader)
+            merger.copy_document_entries(reader, memo)
+    except Exception:
+        if out_path is None and target.exists():
+            target.unlink()
+        raise
+    if out_path is not None:
+        return out_path, merger.shared_objects
+    if target.stat().st_size < pdf_path.stat().st_size:
+        os.replace(target, pdf_path)
+    else:
+        target.unlink()
+    return pdf_path, merger.shared_objects
+
+def count_pdf_pages(pdf_file: Path) -> int:
+    """يعيد عدد صفحات ملف PDF أو 0 إن تعذرت قراءته."""
+    try:
+        reader = PdfReader(str(pdf_file), strict=False)
+        if reader.is_encrypted:
+            reader.decrypt("")
+        return len(reader.pages)
+    except Exception:
+        return 0
+
+def rasterize_pdf(pdf_file: Path, folder_path: Path, file_name: str,
+                  first: Optional[int] = None, last: Optional[int] = None,
+                  backend: Optional[str] = None, density: Optional[int] = None) -> Tuple[str, List[Path]]:
+    """يحوّل صفحات PDF إلى صور PNG رمادية بالنمط {name}-%04d.png (ترقيم الصفحات يبدأ من 1).
+    first/last تحدد نطاق صفحات (شاملًا) بدل الملف كاملًا، وdensity دقة التحويل (افتراضيًا DENSITY).
+    backend يفرض أداة بعينها ('magick' أو 'pdftoppm')، وإلا تُفضّل ImageMagick ثم pdftoppm كبديل.
+    يعيد الأداة المستخدمة وقائمة الصور الناتجة مرتبة.
+    """
+    if backend in (None, 'magick') and MAGICK:
+        magick_cmd = _magick_command(pdf_file, folder_path, file_name, first, last, density)
+        try:
+            subprocess.run(magick_cmd, check=True, capture_output=True, text=True)
+            return 'magick', _rasterized_pages(folder_path, file_name, first, last)
+        except subprocess.CalledProcessError as e:
+            if backend == 'magick':
+                raise
+            print(f"ImageMagick فشل: {e.stderr.strip()}. المحاولة باستخدام pdftoppm...")
+    elif backend is None:
+        print("ImageMagick غير متوفر. المحاولة باستخدام pdftoppm...")
+
+    if not PDFTOPPM:
+        raise RuntimeError("لا ImageMagick ولا pdftoppm متاحان. يرجى تثبيت أحدهما.")
+    pdftoppm_cmd, prefix = _pdftoppm_command(pdf_file, folder_path, file_name, first, last, density)
+    subprocess.run(pdftoppm_cmd, check=True, capture_output=True, text=True)
+    _rename_pdftoppm_output(folder_path, file_name, prefix)
+    return 'pdftoppm', _rasterized_pages(folder_path, file_name, first, last)
+
+def _magick_command(pdf_file: Path, folder_path: Path, file_name: str, first: Optional[int] = None,
+                    last: Optional[int] = None, density: Optional[int] = None) -> List[str]:
+    """أمر ImageMagick لتحويل الملف أو نطاق صفحات منه إلى {name}-%04d.png."""
+    ranged = first is not None and last is not None
+    source = f"{pdf_file}[{first - 1}-{last - 1}]" if ranged else str(pdf_file)
+    return [MAGICK, 'convert', '-density', str(density or CONFIG['DENSITY']), source, '-colorspace', 'Gray', '-contrast-stretch', '0', '-alpha', 'remove', '-strip', '-scene', str(first if ranged else 1), str(folder_path / f"{file_name}-%04d.png")]
+
+def _pdftoppm_command(pdf_file: Path, folder_path: Path, file_name: str, first: Optional[int] = None,
+                      last: Optional[int] = None, density: Optional[int] = None) -> Tuple[List[str], str]:
+    """أمر pdftoppm مع بادئة ملفاته المؤقتة."""
+    # بادئة خاصة بالنطاق حتى لا تتداخل إعادة التسمية مع صفحات دفعات أخرى
+    prefix = f"{file_name}.r{first or 1}"
+    cmd = [PDFTOPPM, '-r', str(density or CONFIG['DENSITY']), '-gray', '-png']
+    if first is not None and last is not None:
+        cmd += ['-f', str(first), '-l', str(last)]
+    return cmd + [str(pdf_file), str(folder_path / prefix)], prefix
+
+def _rename_pdftoppm_output(folder_path: Path, file_name: str, prefix: str):
+    """إعادة تسمية الملفات الناتجة من pdftoppm لتتناسب مع النمط {name}-%04d.png."""
+    for p in folder_path.glob(f"{prefix}-*.png"):
+        m = re.search(r"-(\d+)\.png$", p.name)
+        if m:
+            nn = int(m.group(1))
+            p.rename(folder_path / f"{file_name}-{nn:04d}.png")
+
+def split_pnm_stream(data: bytes) -> List[bytes]:
+    """يقسم تدفق صور PGM/PPM ثنائية متتالية (P5/P6) كما تكتبه ImageMagick إلى stdout إلى صور منفصلة."""
+    frames: List[bytes] = []
+    pos = 0
+    while pos < len(data):
+        start = pos
+        fields: List[int] = []
+        magic = data[pos:pos + 2]
+        if magic not in (b"P5", b"P6"):
+            raise ValueError(f"تنسيق PNM غير مدعوم عند الموضع {pos}.")
+        pos += 2
+        while len(fields) < 3:
+            while data[pos:pos + 1].isspace():
+                pos += 1
+            if data[pos:pos + 1] == b"#":
+                pos = data.index(b"\n", pos) + 1
+                continue
+            m = re.match(rb"\d+", data[pos:pos + 16])
+            if not m:
+                raise ValueError(f"ترويسة PNM تالفة عند الموضع {pos}.")
+            fields.append(int(m.group()))
+            pos += len(m.group())
+        pos += 1  # فراغ واحد بعد القيمة القصوى
+        width, height, maxval = fields
+        channels = 1 if magic == b"P5" else 3
+        pos += width * height * channels * (2 if maxval > 255 else 1)
+        frames.append(data[start:pos])
+    return frames
+
+def rasterize_to_memory(pdf_file: Path, first: int, last: int, backend: Optional[str] = None,
+                        density: Optional[int] = None) -> Tuple[str, List[Tuple[int, bytes]]]:
+    """يحوّل نطاق صفحات إلى صور PGM رمادية في الذاكرة دون كتابة PNG على القرص.
+    يعيد الأداة المستخدمة وقائمة (رقم الصفحة، بايتات PGM).
+    """
+    if backend in (None, 'magick') and MAGICK:
+        magick_cmd = [MAGICK, 'convert', '-density', str(density or CONFIG['DENSITY']), f"{pdf_file}[{first - 1}-{last - 1}]", '-colorspace', 'Gray', '-contrast-stretch', '0', '-alpha', 'remove', '-strip', '-depth', '8', 'pgm:-']
+        try:
+            result = subprocess.run(magick_cmd, check=True, capture_output=True)
+            frames = split_pnm_stream(result.stdout)
+            if len(frames) != last - first + 1:
+                # عدد إطارات مختلف يعني أن ترقيم الصفحات لم يعد موثوقًا
+                raise ValueError(f"أعادت ImageMagick {len(frames)} صفحة بدل {last - first + 1}.")
+            return 'magick', list(zip(range(first, last + 1), frames))
+        except (subprocess.CalledProcessError, ValueError) as e:
+            if backend == 'magick':
+                raise
+            reason = e.stderr.decode('utf-8', 'replace').strip() if isinstance(e, subprocess.CalledProcessError) else e
+            print(f"ImageMagick فشل: {reason}. المحاولة باستخدام pdftoppm...")
+
+    if not PDFTOPPM:
+        raise RuntimeError("لا ImageMagick ولا pdftoppm متاحان. يرجى تثبيت أحدهما.")
+    pages: List[Tuple[int, bytes]] = []
+    for n in range(first, last + 1):
+        # pdftoppm يكتب صفحة واحدة إلى stdout عند تمرير '-' بدل بادئة الملفات
+        pdftoppm_cmd = [PDFTOPPM, '-r', str(density or CONFIG['DENSITY']), '-gray', '-f', str(n), '-l', str(n), '-singlefile', str(pdf_file), '-']
+        result = subprocess.run(pdftoppm_cmd, check=True, capture_output=True)
+        pages.append((n, result.stdout))
+    return 'pdftoppm', pages
+
+def _rasterized_pages(folder_path: Path, file_name: str, first: Optional[int], last: Optional[int]) -> List[Path]:
+    """يسرد صور الصفحات الناتجة عن التحويل (للنطاق المحدد إن وُجد)."""
+    if first is None or last is None:
+        return sorted(folder_path.glob(f"{file_name}-[0-9][0-9][0-9][0-9].png"))
+    candidates = (folder_path / f"{file_name}-{n:04d}.png" for n in range(first, last + 1))
+    return [p for p in candidates if p.exists()]
+
+class JobManifest:
+    """سجل تقدّم مهمة OCR لملف واحد ({name}.ocr-job.json بجانب الملف).
+    يحفظ مجلد العمل المؤقت والصفحات التي حُوّلت وتم التعرّف عليها مع بصمات نواتجها وحالة الدمج،
+    فيستأنف التشغيل التالي الصفحات الناقصة فقط بدل البدء من الصفر.
+    """
+    VERSION = 1
+    SAVE_INTERVAL = 2.0  # ثوانٍ بين عمليات الحفظ التلقائي
+
+    def __init__(self, path: Path, data: dict):
+        self.path = path
+        self.data = data
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+    @staticmethod
+    def path_for(pdf_file: Path) -> Path:
+        return pdf_file.with_name(f"{pdf_file.stem}.ocr-job.json")
 
-        print(f"تحويل {pdf_file.name} إلى صور...")
-        # التحويل إلى صور: فضّل ImageMagick، ثم pdftoppm كبديل
-        converted = False
-        if MAGICK:
-            magick_cmd = [MAGICK, 'convert', '-density', str(CONFIG['DENSITY']), '-colorspace', 'Gray', '-contrast-stretch', '0', '-alpha', 'remove', '-strip', str(pdf_file), str(folder_path / f"{file_name}-%04d.png")]
+    @staticmethod
+    def _source_info(pdf_file: Path) -> dict:
+        st = pdf_file.stat()
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    @classmethod
+    def open(cls, pdf_file: Path, epoch_time: int) -> "JobManifest":
+        """يفتح سجلًا غير مكتمل لنفس الملف والإعدادات إن وُجد، وإلا ينشئ مهمة جديدة."""
+        path = cls.path_for(pdf_file)
+        source = cls._source_info(pdf_file)
+        try:
+            data = json.loads(path.read_text(encoding='utf-8'))
+            if (data.get('version') == cls.VERSION and data.get('status') != 'done'
+                    and data.get('source') == source and data.get('settings') == ocr_settings()
+                    and (pdf_file.parent / data['temp_dir']).is_dir()):
+                print(f"استئناف مهمة سابقة لـ {pdf_file.name} من {data['temp_dir']}...")
+                return cls(path, data)
+        except (OSError, ValueError, KeyError):
+            pass
+        data = {
+            'version': cls.VERSION,
+            'source': source,
+            'settings': ocr_settings(),
+            'temp_dir': f"{epoch_time}_{pdf_file.stem}_temp",
+            'status': 'running',
+            'total_pages': 0,
+            'pages': {},
+            'merged': {},
+        }
+        manifest = cls(path, data)
+        manifest.save(force=True)
+        return manifest
+
+    @property
+    def folder(self) -> Path:
+        return self.path.parent / self.data['temp_dir']
+
+    def _page(self, number: int) -> dict:
+        return self.data['pages'].setdefault(str(number), {})
+
+    def set_total_pages(self, total: int) -> None:
+        with self._lock:
+            self.data['total_pages'] = total
+        self.save()
+
+    def mark_rasterized(self, images: Iterable[Path], file_name: str) -> None:
+        with self._lock:
+            for img in images:
+                self._page(extract_page_number(str(img), file_name))['rasterized'] = True
+        self.save()
+
+    def set_page_info(self, number: int, **info) -> None:
+        """يسجل معلومات إضافية عن صفحة (مصدر صورتها، دقتها...)."""
+        with self._lock:
+            self._page(number).update(info)
+        self.save()
+
+    def page_info(self, number: int) -> dict:
+        return self.data['pages'].get(str(number), {})
+
+    def mark_ocr(self, number: int, out_base: Path) -> bool:
+        """يسجل صفحة كمكتملة مع بصمات نواتجها إذا وُجدت كل الصيغ المطلوبة."""
+        hashes = {}
+        for fmt in dict.fromkeys(CONFIG['OCR_OUTPUTS']):
+            out = Path(f"{out_base}.{fmt}")
+            if not out.exists():
+                return False
+            hashes[fmt] = file_sha256(out)
+        with self._lock:
+            self._page(number)['ocr'] = hashes
+        self.save()
+        return True
+
+    def finished_pages(self, file_name: str) -> set:
+        """يعيد أرقام الصفحات المكتملة التي ما زالت نواتجها موجودة ومطابقة لبصماتها."""
+        done = set()
+        for key, info in list(self.data['pages'].items()):
+            hashes = info.get('ocr')
+            if not hashes:
+                continue
+            base = self.folder / f"{file_name}-{int(key):04d}"
             try:
-                subprocess.run(magick_cmd, check=True, capture_output=True, text=True)
-                converted = True
-            except subprocess.CalledProcessError as e:
-                print(f"ImageMagick فشل: {e.stderr.strip()}. المحاولة باستخدام pdftoppm...")
+                if all(file_sha256(Path(f"{base}.{fmt}")) == h for fmt, h in hashes.items()):
+                    done.add(int(key))
+                    continue
+            except OSError:
+                pass
+            with self._lock:
+                info.pop('ocr', None)
+        return done
+
+    def mark_merged(self, kind: str, out_path: Path) -> None:
+        with self._lock:
+            self.data['merged'][kind] = file_sha256(out_path)
+        self.save(force=True)
+
+    def set_summary(self, **values) -> None:
+        """يسجل إحصاءات على مستوى الملف (مثل عدد الصفحات الفارغة المتخطاة)."""
+        with self._lock:
+            self.data.update(values)
+        self.save()
+
+    def count_pages(self, **info) -> int:
+        """يعدّ الصفحات التي تطابق معلوماتها القيم المعطاة (مثل blank=True)."""
+        with self._lock:
+            return sum(1 for page in self.data['pages'].values()
+                       if all(page.get(k) == v for k, v in info.items()))
+
+    def finish(self) -> None:
+        with self._lock:
+            self.data['status'] = 'done'
+        self.save(force=True)
+
+    def save(self, force: bool = False) -> None:
+        """يحفظ السجل كتابةً ذرّية (ملف مؤقت ثم استبدال)، مع تقليل عدد مرات الحفظ أثناء المعالجة."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_save < self.SAVE_INTERVAL:
+                return
+            self._last_save = now
+            tmp = self.path.with_name(f".{self.path.name}.tmp")
+            tmp.write_text(json.dumps(self.data, ensure_ascii=False, indent=1), encoding='utf-8')
+            os.replace(tmp, self.path)
+
+def _page_ranges(pages: Iterable[int], max_len: int = 0, dpis: Optional[dict] = None) -> List[Tuple[int, int]]:
+    """يجمع أرقام صفحات في نطاقات متصلة (first, last) مع حد أقصى اختياري لطول النطاق.
+    إذا مُرّرت dpis (رقم الصفحة -> الدقة) لا يضم النطاق إلا صفحات بنفس الدقة.
+    """
+    dpis = dpis or {}
+    ranges: List[Tuple[int, int]] = []
+    for n in sorted(set(pages)):
+        if (ranges and ranges[-1][1] == n - 1 and (not max_len or n - ranges[-1][0] < max_len)
+                and dpis.get(n) == dpis.get(n - 1)):
+            ranges[-1] = (ranges[-1][0], n)
         else:
-            print("ImageMagick غير متوفر. المحاولة باستخدام pdftoppm...")
-
-        if not converted:
-            if PDFTOPPM:
-                pdftoppm_cmd = [PDFTOPPM, '-r', str(CONFIG['DENSITY']), '-gray', '-png', str(pdf_file), str(folder_path / file_name)]
-                subprocess.run(pdftoppm_cmd, check=True, capture_output=True, text=True)
-                # إعادة تسمية الملفات الناتجة من pdftoppm لتتناسب مع النمط
-                for p in sorted(folder_path.glob(f"{file_name}-*.png")):
-                    m = re.search(r"-(\d+)\.png$", p.name)
-                    if m:
-                        nn = int(m.group(1))
-                        p.rename(folder_path / f"{file_name}-{nn:04d}.png")
-                converted = True
-            else:
-                raise RuntimeError("لا ImageMagick ولا pdftoppm متاحان. يرجى تثبيت أحدهما.")
-        
-        png_files = sorted([p for p in folder_path.iterdir() if p.suffix == '.png'])
-        if not png_files:
-            raise RuntimeError(f"لم يتم العثور على صور لتحويلها من {pdf_file.name}.")
+            ranges.append((n, n))
+    return ranges
 
-        if not TESS:
-            print("Tesseract غير متوفر. سيتم تخطّي OCR وإنشاء الصور فقط.")
+PAGE_IMAGE_SUFFIXES = ('.png', '.jpg', '.tiff')
+
+def _page_image(folder_path: Path, file_name: str, number: int) -> Optional[Path]:
+    """يعيد صورة الصفحة الموجودة في مجلد العمل (محوّلة أو أصلية) إن وُجدت."""
+    for suffix in PAGE_IMAGE_SUFFIXES:
+        p = folder_path / f"{file_name}-{number:04d}{suffix}"
+        if p.exists():
+            return p
+    return None
+
+def _single_filter(xobj) -> Optional[str]:
+    """يعيد اسم المرشح إذا كان للصورة مرشح واحد فقط."""
+    filt = xobj.get("/Filter")
+    if isinstance(filt, ArrayObject):
+        filt = filt[0] if len(filt) == 1 else None
+    return filt
+
+def ccitt_to_tiff(data: bytes, width: int, height: int, params: Optional[dict], dpi: int) -> bytes:
+    """يغلّف بيانات CCITT الخام من PDF بترويسة TIFF دون فك ترميزها، مع مراعاة /K و/BlackIs1."""
+    params = params or {}
+    k = int(params.get("/K", 0))
+    black_is_1 = bool(params.get("/BlackIs1", False))
+    compression = 4 if k < 0 else 3  # 4 = Group 4، 3 = Group 3
+    entries = [
+        (256, 4, width), (257, 4, height), (258, 3, 1), (259, 3, compression),
+        # الأشواط "البيضاء" المرمّزة تصبح بتات 0؛ مع BlackIs1 تعني 0 الأسود (BlackIsZero) وإلا الأبيض (WhiteIsZero)
+        (262, 3, 1 if black_is_1 else 0),
+        (273, 4, 0), (277, 3, 1), (278, 4, height), (279, 4, len(data)),
+        (282, 5, 0), (283, 5, 0),
+    ]
+    if compression == 3:
+        entries.append((292, 4, 1 if k > 0 else 0))  # T4Options: ترميز ثنائي الأبعاد عند K>0
+    entries.append((296, 3, 2))  # وحدة الدقة: إنش
+    ifd_size = 2 + 12 * len(entries) + 4
+    rational_offset = 8 + ifd_size
+    data_offset = rational_offset + 8
+    out = [b"II*\x00", struct.pack("<I", 8), struct.pack("<H", len(entries))]
+    for tag, typ, value in entries:
+        if tag == 273:
+            value = data_offset
+        elif typ == 5:
+            value = rational_offset  # XResolution وYResolution يشتركان في نفس القيمة
+        if typ == 3:
+            out.append(struct.pack("<HHIHH", tag, typ, 1, value, 0))
+        else:
+            out.append(struct.pack("<HHII", tag, typ, 1, value))
+    out.append(struct.pack("<I", 0))
+    out.append(struct.pack("<II", dpi, 1))
+    out.append(data)
+    return b"".join(out)
+
+def native_page_image(page) -> Optional[Tuple[str, bytes, int]]:
+    """إذا كانت الصفحة صورة واحدة تغطيها كاملة (الحالة الشائعة للكتب الممسوحة) يعيد
+    (الامتداد، بايتات صورة يقرؤها Tesseract، الدقة الأصلية بالـdpi)، وإلا None لتُحوّل بالطريقة المعتادة.
+    تُستبعد الصفحات المدوّرة أو التي فيها خطوط أو نماذج أو أقنعة لأن صورتها وحدها لا تمثل الصفحة.
+    """
+    resources = page.get("/Resources")
+    if resources is None or page.get("/Rotate", 0) % 360:
+        return None
+    resources = resources.get_object()
+    if resources.get("/Font"):
+        return None
+    xobjects = resources.get("/XObject")
+    if xobjects is None:
+        return None
+    xobjects = xobjects.get_object()
+    if len(xobjects) != 1:
+        return None
+    xobj = list(xobjects.values())[0].get_object()
+    if xobj.get("/Subtype") != "/Image" or any(k in xobj for k in ("/SMask", "/Mask", "/ImageMask", "/Decode")):
+        return None
+
+    width, height = int(xobj["/Width"]), int(xobj["/Height"])
+    box = page.mediabox
+    page_w, page_h = float(box.width), float(box.height)
+    if not (width and height and page_w and page_h):
+        return None
+    # الصورة تغطي الصفحة: نسبة الأبعاد متطابقة تقريبًا
+    if abs(width / height - page_w / page_h) > 0.03 * (page_w / page_h):
+        return None
+    dpi = round(width * 72.0 / page_w)
+    if dpi < 100:
+        return None  # الصور الصغيرة جدًا يفضّل تكبيرها بالتحويل المعتاد
+
+    filt = _single_filter(xobj)
+    colorspace = xobj.get("/ColorSpace")
+    bits = xobj.get("/BitsPerComponent", 8)
+    if filt == "/DCTDecode" and colorspace in ("/DeviceGray", "/DeviceRGB"):
+        return '.jpg', xobj._data, dpi
+    if filt == "/CCITTFaxDecode":
+        params = xobj.get("/DecodeParms")
+        if isinstance(params, ArrayObject):
+            params = params[0] if len(params) == 1 else None
+        params = params.get_object() if params is not None else None
+        return '.tiff', ccitt_to_tiff(xobj._data, width, height, params, dpi), dpi
+    if filt == "/FlateDecode" and colorspace in ("/DeviceGray", "/DeviceRGB") and bits in (1, 8):
+        mode = "1" if bits == 1 else ("L" if colorspace == "/DeviceGray" else "RGB")
+        if mode == "1" and colorspace != "/DeviceGray":
+            return None
+        img = Image.frombytes(mode, (width, height), xobj.get_data())
+        buf = io.BytesIO()
+        img.save(buf, "PNG", dpi=(dpi, dpi))
+        return '.png', buf.getvalue(), dpi
+    return None
+
+def extract_native_page_images(pdf_file: Path, folder_path: Path, file_name: str, pages: List[int],
+                               manifest: Optional["JobManifest"] = None) -> List[Path]:
+    """يكتب الصورة الأصلية لكل صفحة مكوّنة من صورة واحدة بالاسم {name}-NNNN.<ext> بدقتها الحقيقية
+    بدل إعادة تحويلها بـ ImageMagick. يعيد الصور المكتوبة؛ الصفحات الأخرى تبقى للتحويل المعتاد.
+    """
+    try:
+        reader = PdfReader(str(pdf_file), strict=False)
+        if reader.is_encrypted:
+            reader.decrypt("")
+    except Exception as e:
+        print(f"تعذر فحص الصور المضمّنة في {pdf_file.name}: {e}")
+        return []
+    images: List[Path] = []
+    for n in pages:
+        try:
+            native = native_page_image(reader.pages[n - 1])
+        except Exception:
+            native = None
+        if native is None:
+            continue
+        suffix, data, dpi = native
+        out = folder_path / f"{file_name}-{n:04d}{suffix}"
+        out.write_bytes(data)
+        images.append(out)
+        if manifest is not None:
+            manifest.set_page_info(n, source='native', dpi=dpi)
+    return images
+
+def _is_script_letter(ch: str) -> bool:
+    """حرف عربي (بما فيه أشكال العرض) أو لاتيني؛ غير ذلك يدل غالبًا على ترميز خطوط مشوّه."""
+    code = ord(ch)
+    if 0x0600 <= code <= 0x06FF or 0x0750 <= code <= 0x077F or 0xFB50 <= code <= 0xFDFF or 0xFE70 <= code <= 0xFEFF:
+        return True
+    return code < 0x0250 and ch.isalpha()
+
+def page_text_layer(page) -> Optional[str]:
+    """يعيد نص الصفحة إذا كانت تحتوي طبقة نص صالحة (طويلة كفاية ومعظمها أحرف عربية/لاتينية)، وإلا None."""
+    text = unicodedata.normalize("NFKC", page.extract_text() or "")
+    chars = [ch for ch in text if not ch.isspace()]
+    if len(chars) < CONFIG['TEXT_LAYER_MIN_CHARS']:
+        return None
+    letters = sum(1 for ch in chars if _is_script_letter(ch))
+    if letters < CONFIG['TEXT_LAYER_MIN_RATIO'] * len(chars):
+        return None
+    return text
+
+def extract_text_layer_pages(pdf_file: Path, folder_path: Path, file_name: str, pages: List[int],
+                             manifest: "JobManifest") -> List[int]:
+    """يكتب لكل صفحة ذات طبقة نص نصَّها إلى {name}-NNNN.txt والصفحة الأصلية إلى {name}-NNNN.pdf
+    كأنها ناتج OCR، ويسجلها مكتملة في السجل. يعيد أرقام الصفحات التي لن تحتاج تحويلًا ولا OCR.
+    """
+    try:
+        reader = PdfReader(str(pdf_file), strict=False)
+        if reader.is_encrypted:
+            reader.decrypt("")
+    except Exception as e:
+        print(f"تعذر فحص طبقة النص في {pdf_file.name}: {e}")
+        return []
+    done: List[int] = []
+    for n in pages:
+        try:
+            text = page_text_layer(reader.pages[n - 1])
+            if text is None:
+                continue
+            base = folder_path / f"{file_name}-{n:04d}"
+            if 'txt' in CONFIG['OCR_OUTPUTS']:
+                Path(f"{base}.txt").write_text(text, encoding='utf-8')
+            if 'pdf' in CONFIG['OCR_OUTPUTS']:
+                with StreamingPDFMerger(Path(f"{base}.pdf")) as merger:
+                    merger.append_pages(reader, [n - 1])
+            for fmt in CONFIG['OCR_OUTPUTS']:
+                if fmt not in ('txt', 'pdf'):  # لا مواضع كلمات من Tesseract لهذه الصفحات
+                    Path(f"{base}.{fmt}").write_bytes(b"")
+        except Exception as e:
+            print(f"تعذر نسخ طبقة النص للصفحة {n}: {e}")
+            continue
+        manifest.set_page_info(n, source='text')
+        if manifest.mark_ocr(n, base):
+            done.append(n)
+    return done
+
+def page_image_dpi(page) -> Optional[int]:
+    """يقدّر دقة الصور المضمّنة في الصفحة (أعلى دقة بين صورها نسبةً إلى أبعاد الصفحة).
+    يعيد None للصفحات بلا صور أو التي فيها نص/خطوط، فتُحوّل بالدقة الافتراضية.
+    """
+    resources = page.get("/Resources")
+    if resources is None:
+        return None
+    resources = resources.get_object()
+    if resources.get("/Font"):
+        return None
+    xobjects = resources.get("/XObject")
+    if xobjects is None:
+        return None
+    box = page.mediabox
+    # الصورة توضع في فضاء MediaBox قبل التدوير، فلا يُبدّل العرض والارتفاع مع /Rotate
+    page_w, page_h = float(box.width), float(box.height)
+    if not (page_w and page_h):
+        return None
+    best = 0.0
+    for ref in xobjects.get_object().values():
+        xobj = ref.get_object()
+        if xobj.get("/Subtype") != "/Image":
+            continue
+        width, height = int(xobj.get("/Width", 0)), int(xobj.get("/Height", 0))
+        best = max(best, width * 72.0 / page_w, height * 72.0 / page_h)
+    return round(best) or None
+
+def choose_page_dpis(pdf_file: Path, pages: List[int]) -> dict:
+    """يختار دقة التحويل لكل صفحة من دقة صورتها الممسوحة ضمن [DPI_MIN, DPI_MAX]؛
+    الصفحات الأخرى تأخذ DENSITY. التكبير فوق دقة المسح لا يحسّن التعرّف ويضاعف عدد البكسلات.
+    """
+    dpis = {n: CONFIG['DENSITY'] for n in pages}
+    try:
+        reader = PdfReader(str(pdf_file), strict=False)
+        if reader.is_encrypted:
+            reader.decrypt("")
+        for n in pages:
+            try:
+                native = page_image_dpi(reader.pages[n - 1])
+            except Exception:
+                native = None
+            if native:
+                dpis[n] = max(CONFIG['DPI_MIN'], min(CONFIG['DPI_MAX'], native))
+    except Exception as e:
+        print(f"تعذر فحص دقة الصفحات في {pdf_file.name}: {e}. استعمال DENSITY لكل الصفحات.")
+    return dpis
+
+def rasterize_pages_parallel(pdf_file: Path, folder_path: Path, file_name: str,
+                             pages: List[int], dpis: Optional[dict] = None) -> List[Path]:
+    """يقسم الصفحات إلى نطاقات متصلة ويحوّلها بعمليات magick/pdftoppm متزامنة بدل عملية واحدة
+    تستهلك نواة واحدة. أسماء الصور تبقى بالنمط {name}-%04d.png نفسه. يعيد الصور الناتجة مرتبة.
+    dpis (اختياري) دقة كل صفحة؛ الصفحات المختلفة الدقة تُحوّل في نطاقات منفصلة.
+    """
+    dpis = dpis or {}
+    workers = max(1, CONFIG['RASTER_WORKERS'] or CONFIG['MAX_WORKERS'])
+    span = max(1, -(-len(pages) // workers))  # قسمة مع التقريب للأعلى
+    ranges = _page_ranges(pages, span, dpis)
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        return rasterize_pdf(pdf_file, folder_path, file_name, first, last, density=dpis.get(first))[1]
+    images: List[Path] = []
+    with ThreadPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+        futures = [executor.submit(rasterize_pdf, pdf_file, folder_path, file_name, first, last, None, dpis.get(first))
+                   for first, last in ranges]
+        for fut in futures:
+            images.extend(fut.result()[1])
+    return images
+
+def ink_ratio(image: Image.Image) -> float:
+    """يقيس نسبة البكسلات الداكنة في نسخة مصغّرة رمادية من الصورة بعد قص الهوامش.
+    التصغير بأخذ عينات (NEAREST) لا بالمتوسط، حتى لا تبهت الخطوط الرفيعة فتُحسب الصفحة فارغة.
+    """
+    mx, my = int(image.width * CONFIG['BLANK_MARGIN']), int(image.height * CONFIG['BLANK_MARGIN'])
+    if image.width - 2 * mx > 0 and image.height - 2 * my > 0:
+        image = image.crop((mx, my, image.width - mx, image.height - my))
+    factor = max(1, max(image.width, image.height) // 1000)
+    gray = image.resize((max(1, image.width // factor), max(1, image.height // factor)), Image.NEAREST).convert("L")
+    histogram = gray.histogram()
+    total = sum(histogram)
+    return sum(histogram[:CONFIG['BLANK_DARK_LEVEL']]) / total if total else 0.0
+
+def is_blank_page(image_file: Path, image_data: Optional[bytes] = None) -> bool:
+    """هل الصفحة فارغة أو شبه فارغة؟ فحص رخيص يسبق Tesseract."""
+    try:
+        with Image.open(io.BytesIO(image_data) if image_data is not None else image_file) as im:
+            return ink_ratio(im) < CONFIG['BLANK_INK_RATIO']
+    except Exception:
+        return False
+
+def write_blank_page_outputs(image_file: Path, image_data: Optional[bytes] = None, dpi: Optional[int] = None):
+    """يكتب نواتج صفحة فارغة دون Tesseract: نص فارغ وصفحة PDF تحتوي الصورة فقط."""
+    out_base = image_file.with_suffix('')
+    if 'txt' in CONFIG['OCR_OUTPUTS']:
+        Path(f"{out_base}.txt").write_text("", encoding='utf-8')
+    if 'pdf' in CONFIG['OCR_OUTPUTS']:
+        with Image.open(io.BytesIO(image_data) if image_data is not None else image_file) as im:
+            im.save(f"{out_base}.pdf", "PDF", resolution=dpi or CONFIG['DENSITY'])
+    for fmt in CONFIG['OCR_OUTPUTS']:
+        if fmt not in ('txt', 'pdf'):
+            Path(f"{out_base}.{fmt}").write_bytes(b"")
+
+def _ocr_page(image_file: Path, file_base: str, manifest: Optional[JobManifest] = None,
+              image_data: Optional[bytes] = None):
+    """يشغّل OCR على صفحة واحدة بدقتها المسجلة في سجل المهمة ثم يسجل حالتها ومدتها واكتمالها.
+    الصفحات الفارغة تُكتب نواتجها مباشرة دون Tesseract. الصفحات التي تجاوزت المهلة أو فشلت
+    تُحذف نواتجها الجزئية ولا تُسجل مكتملة، فيعيدها التشغيل التالي.
+    """
+    number = extract_page_number(str(image_file), file_base)
+    dpi = manifest.page_info(number).get('dpi') if manifest is not None else None
+    start = time.monotonic()
+    if CONFIG['BLANK_DETECT'] and is_blank_page(image_file, image_data):
+        try:
+            write_blank_page_outputs(image_file, image_data, dpi)
+        except Exception as e:
+            print(f"تعذر كتابة نواتج الصفحة الفارغة {image_file.name}: {e}")
+            status = process_image_for_ocr(image_file, file_base, image_data, dpi)
         else:
-            print(f"تشغيل OCR على {len(png_files)} صورة...")
-            with ThreadPoolExecutor(max_workers=CONFIG['MAX_WORKERS']) as executor:
-                executor.map(lambda img_file: process_image_for_ocr(img_file, file_name), png_files)
+            status = 'blank'
+    else:
+        status = process_image_for_ocr(image_file, file_base, image_data, dpi)
+    _finish_ocr_page(image_file, number, status, time.monotonic() - start, manifest)
+
+def _finish_ocr_page(image_file: Path, number: int, status: str, seconds: float,
+                     manifest: Optional[JobManifest] = None):
+    """يسجل نتيجة OCR للصفحة: الصفحة التي تجاوزت المهلة أو فشلت تُحذف نواتجها الجزئية فلا تُدمج
+    ولا تُعد مكتملة عند الاستئناف، وغيرها تُسجل مكتملة مع بصمات نواتجها.
+    """
+    if status in ('timeout', 'error'):
+        discard_ocr_outputs(image_file.with_suffix(''))
+    if manifest is not None:
+        _record_ocr_status(manifest, number, status, seconds)
+        if status not in ('timeout', 'error'):
+            manifest.mark_ocr(number, image_file.with_suffix(''))
+
+def _record_ocr_status(manifest: JobManifest, number: int, status: str, seconds: float):
+    """يسجل حالة OCR للصفحة ومدتها في سجل المهمة (لتقرير المهلات ومحاولات الإعادة).
+    ocr_dpi دقة الصورة التي عالجها Tesseract فعلًا (تختلف في محاولة الإعادة المصغّرة).
+    """
+    dpi = manifest.page_info(number).get('dpi')
+    info = {'ocr_status': status, 'ocr_seconds': round(seconds, 2),
+            'ocr_dpi': _fallback_dpi(dpi) if status == 'fallback' else dpi}
+    if status == 'blank':
+        info['blank'] = True
+    manifest.set_page_info(number, **info)
+
+def read_mem_available_mb() -> Optional[int]:
+    """يقرأ MemAvailable من /proc/meminfo بالميغابايت، أو None إن لم يتوفر (غير لينكس)."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def read_load_average() -> Optional[float]:
+    """يقرأ متوسط الحمل لآخر دقيقة من /proc/loadavg، أو None إن لم يتوفر."""
+    try:
+        with open("/proc/loadavg", "r") as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+def adapt_worker_limit(limit: int, active: int, mem_mb: Optional[int], load: Optional[float],
+                       cpus: int, threads: int, low: int, high: int) -> int:
+    """يحسب الحد الجديد لصفحات OCR المتزامنة خطوة واحدة في كل مرة:
+    ينقص فورًا إذا اقتربت الذاكرة المتاحة من الاحتياطي أو تجاوز الحمل عدد الأنوية،
+    ويزيد واحدًا فقط إذا اتسعت الذاكرة لعملية أخرى وبقي في المعالج متسع لخيوطها.
+    """
+    per_worker, reserve = CONFIG['MEM_PER_WORKER_MB'], CONFIG['MEM_RESERVE_MB']
+    if mem_mb is not None and mem_mb < reserve:
+        limit = min(limit, active) - 1
+    elif load is not None and load > cpus:
+        limit -= 1
+    elif ((mem_mb is None or mem_mb - reserve >= per_worker)
+          and (load is None or load + threads <= cpus)):
+        limit += 1
+    return max(low, min(high, limit))
+
+class AdaptiveLimiter:
+    """بوابة تحدد عدد صفحات OCR المتزامنة بين حدين حسب الذاكرة المتاحة والحمل.
+    تبدأ من الحد الأعلى (كالحد الثابت MAX_WORKERS) ولا تنزل عنه إلا تحت ضغط الذاكرة أو الحمل.
+    يُعاد القياس كل INTERVAL ثانية عند طلب فتحة؛ إذا لم تتوفر /proc يبقى الحد ثابتًا على الحد الأعلى.
+    """
+    INTERVAL = 2.0
+
+    def __init__(self, low: int, high: int, threads: int = 1):
+        self.high = max(1, high)
+        self.low = max(1, min(low, self.high))
+        self.threads = threads
+        self.cpus = os.cpu_count() or 1
+        self.active = 0
+        self.adaptive = read_mem_available_mb() is not None or read_load_average() is not None
+        self.limit = self.high
+        self._checked = 0.0
+        self._cond = threading.Condition()
+        self._wakeup = None  # asyncio.Event لمنتظري الحلقة (انظر __aenter__)
+
+    def _adjust(self) -> None:
+        now = time.monotonic()
+        if not self.adaptive or now - self._checked < self.INTERVAL:
+            return
+        self._checked = now
+        limit = adapt_worker_limit(self.limit, self.active, read_mem_available_mb(), read_load_average(),
+                                   self.cpus, self.threads, self.low, self.high)
+        if limit != self.limit:
+            if limit < self.limit:
+                print(f"تقليل صفحات OCR المتزامنة إلى {limit} (ذاكرة أو حمل مرتفع).")
+            self.limit = limit
+            self._cond.notify_all()
+
+    def __enter__(self):
+        with self._cond:
+            self._adjust()
+            while self.active >= self.limit:
+                self._cond.wait(self.INTERVAL)
+                self._adjust()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+        return False
+
+    async def __aenter__(self):
+        """مثل __enter__ داخل حلقة asyncio: تنتظر الفتحة دون حجز خيط.
+        تُستعمل البوابة الواحدة إما من خيوط أو من حلقة واحدة، لا من الاثنين معًا.
+        """
+        while True:
+            with self._cond:
+                self._adjust()
+                if self.active < self.limit:
+                    self.active += 1
+                    return self
+                if self._wakeup is None:
+                    self._wakeup = asyncio.Event()
+                wakeup = self._wakeup
+            try:
+                await asyncio.wait_for(wakeup.wait(), self.INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+        wakeup, self._wakeup = self._wakeup, None
+        if wakeup is not None:
+            wakeup.set()
+        return False
+
+def ocr_limiter() -> AdaptiveLimiter:
+    """ينشئ بوابة OCR لملف: ثابتة على ocr_split() أو متكيفة بين WORKERS_MIN وذلك الحد."""
+    workers, threads = ocr_split()
+    if not CONFIG['ADAPTIVE_WORKERS']:
+        return AdaptiveLimiter(workers, workers, threads)
+    return AdaptiveLimiter(CONFIG['WORKERS_MIN'], workers, threads)
+
+def _split_candidates(budget: int) -> List[Tuple[int, int]]:
+    """تقسيمات (عمليات، خيوط) المرشحة للقياس: خيوط 1، 2، 4... ما دامت ضمن الميزانية."""
+    candidates, threads = [], 1
+    while threads <= budget:
+        candidates.append(ocr_split(budget, threads))
+        threads *= 2
+    return list(dict.fromkeys(candidates))
+
+def tune_ocr_split(images: List[Path]) -> Tuple[int, int]:
+    """يقيس كل تقسيم مرشح على عينة من صور الصفحات بأمر tesseract (نواتج في مجلد مؤقت يُحذف)
+    ويعتمد الأسرع في OCR_THREADS لبقية التشغيل. يُقاس مرة واحدة لكل عملية.
+    """
+    budget = max(1, CONFIG['MAX_WORKERS'])
+    sample = images[:CONFIG['OCR_TUNE_PAGES'] or budget]
+    candidates = _split_candidates(budget)
+    if len(candidates) < 2 or not sample:
+        return ocr_split()
+    lang, configs = _tesseract_passes()[0]
+    timings = {}
+    with tempfile.TemporaryDirectory(prefix="ocr-tune-") as tmp:
+        for workers, threads in candidates:
+            env = _ocr_env(threads)
+
+            def run(img: Path):
+                cmd = _tesseract_command(str(img), str(Path(tmp) / img.stem), lang, configs)
+                subprocess.run(cmd, check=True, capture_output=True, env=env)
+
+            start = time.monotonic()
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(run, sample))
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"تعذر قياس التقسيم {workers}×{threads}: {e}")
+                continue
+            timings[(workers, threads)] = time.monotonic() - start
+            print(f"قياس OCR: {workers} عملية × {threads} خيط = {timings[(workers, threads)]:.1f} ث لـ {len(sample)} صفحة")
+    if timings:
+        best = min(timings, key=timings.get)
+        CONFIG['OCR_THREADS'] = best[1]
+        print(f"اعتماد {best[0]} عملية × {best[1]} خيط لـ OCR.")
+    CONFIG['OCR_TUNE'] = False
+    return ocr_split()
+
+def _ocr_pages_pipelined(pdf_file: Path, folder_path: Path, file_name: str,
+                         ready: List[Path], to_render: List[int], manifest: JobManifest,
+                         dpis: Optional[dict] = None) -> int:
+    """يحوّل الصفحات على دفعات ويمرر كل صفحة جاهزة إلى OCR عبر طابور محدود.
+    التحويل والتعرّف يعملان بالتوازي، ولا يبقى على القرص إلا عدد قليل من الصور
+    (ولا شيء منها مع IN_MEMORY حيث تبقى الصور في الذاكرة حتى تصل إلى Tesseract).
+    ready صور موجودة مسبقًا (من تشغيل سابق) وto_render أرقام الصفحات التي تحتاج تحويلًا.
+    يعيد عدد الصفحات التي مرت عبر OCR.
+    """
+    limiter = ocr_limiter()
+    workers = limiter.high
+    pages: queue.Queue = queue.Queue(maxsize=max(1, CONFIG['PIPELINE_QUEUE']))
+    errors: List[Exception] = []
+    done = [0]
+    done_lock = threading.Lock()
+
+    def produce():
+        backend = None
+        try:
+            for img in ready:
+                pages.put((img, None))
+            for first, last in _page_ranges(to_render, max(1, CONFIG['PIPELINE_CHUNK']), dpis):
+                density = (dpis or {}).get(first)
+                if CONFIG['IN_MEMORY']:
+                    try:
+                        backend, rendered = rasterize_to_memory(pdf_file, first, last, backend, density)
+                    except ValueError as e:
+                        print(f"{e} تحويل الصفحات {first}-{last} عبر القرص...")
+                    else:
+                        for n, data in rendered:
+                            pages.put((folder_path / f"{file_name}-{n:04d}.pgm", data))
+                        continue
+                backend, images = rasterize_pdf(pdf_file, folder_path, file_name, first, last, backend, density)
+                manifest.mark_rasterized(images, file_name)
+                for img in images:
+                    pages.put((img, None))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for _ in range(workers):
+                pages.put(None)
+
+    def consume():
+        while True:
+            item = pages.get()
+            if item is None:
+                return
+            img, data = item
+            try:
+                with limiter:
+                    _ocr_page(img, file_name, manifest, data)
+            except Exception as e:
+                # خطأ صفحة واحدة لا يوقف المستهلك، وإلا بقي المنتج معلقًا على طابور لا يُفرَّغ
+                print(f"حدث خطأ أثناء OCR للصورة {img.name}: {e}")
+                try:
+                    discard_ocr_outputs(img.with_suffix(''))
+                    manifest.set_page_info(extract_page_number(str(img), file_name), ocr_status='error')
+                except Exception as e2:
+                    print(f"تعذر تسجيل فشل الصورة {img.name}: {e2}")
+            with done_lock:
+                done[0] += 1
+            if data is None and not CONFIG['KEEP_IMAGES']:
+                try:
+                    img.unlink()
+                except OSError as e:
+                    print(f"فشل حذف الصورة المؤقتة {img.name}: {e}")
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in range(workers):
+            executor.submit(consume)
+    producer.join()
+    if errors:
+        raise errors[0]
+    return done[0]
+
+# تشغيل الأدوات الخارجية عبر asyncio
+class AsyncToolRunner:
+    """يشغّل أوامر magick/pdftoppm/tesseract من حلقة asyncio واحدة: حد تزامن (Semaphore) لكل أداة،
+    ومهلة لكل عملية، وقتل العملية عند انتهاء المهلة أو إلغاء المهمة، فلا تبقى عملية معلّقة تحجز خيطًا.
+    يُنشأ داخل الحلقة التي سيعمل فيها.
+    """
 
+    def __init__(self, limits: dict, timeouts: Optional[dict] = None):
+        self._limits = {tool: asyncio.Semaphore(max(1, n)) for tool, n in limits.items()}
+        self.timeouts = dict(timeouts or {})
+
+    async def run(self, tool: str, cmd: List[str], input: Optional[bytes] = None,
+                  env: Optional[dict] = None, timeout: Optional[float] = None) -> bytes:
+        """ينفّذ أمرًا ويعيد stdout. يرفع CalledProcessError عند الفشل وTimeoutExpired عند تجاوز المهلة."""
+        timeout = timeout if timeout is not None else self.timeouts.get(tool)
+        async with self._limits[tool]:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env)
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(input), timeout or None)
+            except asyncio.TimeoutError:
+                await self._kill(proc)
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            except BaseException:  # إلغاء المهمة (CancelledError) أو مقاطعة
+                await self._kill(proc)
+                raise
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, out, err)
+        return out
+
+    @staticmethod
+    async def _kill(proc) -> None:
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+
+async def rasterize_pdf_async(runner: AsyncToolRunner, pdf_file: Path, folder_path: Path, file_name: str,
+                              first: int, last: int, density: Optional[int] = None) -> List[Path]:
+    """مثل rasterize_pdf لنطاق صفحات لكن عبر AsyncToolRunner (ImageMagick ثم pdftoppm كبديل)."""
+    if MAGICK:
+        try:
+            await runner.run('magick', _magick_command(pdf_file, folder_path, file_name, first, last, density))
+            return _rasterized_pages(folder_path, file_name, first, last)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            if not PDFTOPPM:
+                raise
+            print(f"ImageMagick فشل للصفحات {first}-{last}: {e}. المحاولة باستخدام pdftoppm...")
+    if not PDFTOPPM:
+        raise RuntimeError("لا ImageMagick ولا pdftoppm متاحان. يرجى تثبيت أحدهما.")
+    cmd, prefix = _pdftoppm_command(pdf_file, folder_path, file_name, first, last, density)
+    await runner.run('pdftoppm', cmd)
+    _rename_pdftoppm_output(folder_path, file_name, prefix)
+    return _rasterized_pages(folder_path, file_name, first, last)
+
+async def process_image_for_ocr_async(runner: AsyncToolRunner, image_file: Path, dpi: Optional[int] = None) -> str:
+    """مثل process_image_for_ocr لكن دون حجز خيط: أمر tesseract عبر AsyncToolRunner،
+    أو عملية tesserocr دائمة ينتظرها الحلقة مباشرة. تُستعمل ذاكرة OCR نفسها وسياسة المهلة والإعادة نفسها.
+    يعيد الحالة: 'ok' أو 'fallback' أو 'timeout' أو 'error'.
+    """
+    loop = asyncio.get_running_loop()
+    out_base = image_file.with_suffix('')
+    try:
+        cache = get_ocr_cache()
+        key = None
+        if cache is not None:
+            # قراءة الصورة وبصمتها ونسخ النواتج من الذاكرة عمل على القرص يُنقل إلى خيط مساعد
+            key = await loop.run_in_executor(None, lambda: cache.make_key(image_file.read_bytes(), dpi))
+            if await loop.run_in_executor(None, cache.get, key, out_base):
+                return 'ok'
+        try:
+            used_api = False
+            if ocr_engine() == 'api':
+                try:
+                    await asyncio.wrap_future(get_ocr_pool().submit(
+                        _tess_worker_ocr, str(image_file), str(out_base), _tesseract_passes(), dpi, _ocr_timeout()))
+                    used_api = True
+                except TimeoutError:
+                    raise
+                except Exception as e:
+                    _ocr_api_failed(image_file, e)
+            if not used_api:
+                for lang, configs in _tesseract_passes():
+                    await runner.run('tesseract', _tesseract_command(str(image_file), str(out_base), lang, configs, dpi),
+                                     env=_ocr_env())
+        except (subprocess.TimeoutExpired, TimeoutError):
+            if not CONFIG['OCR_RETRY']:
+                print(f"تجاوز Tesseract المهلة ({_ocr_timeout()} ث) للصورة {image_file.name}، أُوقفت العملية.")
+                return 'timeout'
+            print(f"تجاوز Tesseract المهلة للصورة {image_file.name}. إعادة المحاولة بإعدادات أخف...")
+            discard_ocr_outputs(out_base)
+            fallback = await loop.run_in_executor(None, fallback_image_bytes, image_file, None)
+            try:
+                for cmd in _fallback_commands(out_base, dpi):
+                    await runner.run('tesseract', cmd, input=fallback, env=_ocr_env())
+            except subprocess.TimeoutExpired:
+                print(f"تجاوزت محاولة الإعادة المهلة أيضًا للصورة {image_file.name}.")
+                return 'timeout'
+            return 'fallback'
+        if cache is not None and key is not None:
+            await loop.run_in_executor(None, cache.put, key, out_base, CONFIG['OCR_OUTPUTS'])
+        return 'ok'
+    except subprocess.CalledProcessError as e:
+        print(f"حدث خطأ في Tesseract أثناء معالجة الصورة {image_file.name}: {e.stderr.decode('utf-8', 'replace')}")
+    except Exception as e:
+        print(f"حدث خطأ أثناء معالجة الصورة {image_file.name}: {e}")
+    return 'error'
+
+async def _ocr_page_async(runner: AsyncToolRunner, image_file: Path, file_base: str, manifest: JobManifest):
+    """مثل _ocr_page داخل حلقة asyncio؛ فحص الصفحة الفارغة وتسجيل النتيجة (بصمات النواتج وحفظ السجل)
+    تعمل في خيط مساعد لأنها حساب على المعالج أو قراءة من القرص.
+    """
+    loop = asyncio.get_running_loop()
+    number = extract_page_number(str(image_file), file_base)
+    dpi = manifest.page_info(number).get('dpi')
+    start = time.monotonic()
+    if CONFIG['BLANK_DETECT'] and await loop.run_in_executor(None, is_blank_page, image_file):
+        try:
+            await loop.run_in_executor(None, write_blank_page_outputs, image_file, None, dpi)
+            status = 'blank'
+        except Exception as e:
+            print(f"تعذر كتابة نواتج الصفحة الفارغة {image_file.name}: {e}")
+            status = await process_image_for_ocr_async(runner, image_file, dpi)
+    else:
+        status = await process_image_for_ocr_async(runner, image_file, dpi)
+    await loop.run_in_executor(None, _finish_ocr_page, image_file, number, status, time.monotonic() - start, manifest)
+
+def _mark_pages_failed(manifest: JobManifest, numbers: Iterable[int]) -> None:
+    """يسجل صفحات تعذر تحويلها إلى صور بحالة 'error'."""
+    for n in numbers:
+        manifest.set_page_info(n, ocr_status='error')
+
+async def _ocr_document_async(pdf_file: Path, folder_path: Path, file_name: str, ready: List[Path],
+                              to_render: List[int], manifest: JobManifest, dpis: Optional[dict] = None) -> int:
+    """يجدول تحويل نطاقات الصفحات وOCR كل صفحة كمهام asyncio: كل نطاق يُحوَّل ثم تُرسل صفحاته إلى OCR فورًا.
+    عدد النطاقات المحوّلة التي لم يكتمل OCR صفحاتها محدود، فلا تتراكم الصور على القرص.
+    يعيد عدد الصفحات التي مرت عبر OCR.
+    """
+    limiter = ocr_limiter()  # نفس البوابة المتكيفة التي يستعملها مسار الخيوط
+    raster_workers = max(1, CONFIG['RASTER_WORKERS'] or CONFIG['MAX_WORKERS'])
+    runner = AsyncToolRunner({'magick': raster_workers, 'pdftoppm': raster_workers, 'tesseract': limiter.high},
+                             CONFIG['TOOL_TIMEOUTS'])
+    window = asyncio.Semaphore(raster_workers + 1)
+    done = 0
+
+    async def ocr(img: Path):
+        nonlocal done
+        async with limiter:
+            await _ocr_page_async(runner, img, file_name, manifest)
+        done += 1
+        if not CONFIG['KEEP_IMAGES']:
+            try:
+                img.unlink()
+            except OSError as e:
+                print(f"فشل حذف الصورة المؤقتة {img.name}: {e}")
+
+    async def render_and_ocr(first: int, last: int):
+        async with window:
+            try:
+                images = await rasterize_pdf_async(runner, pdf_file, folder_path, file_name, first, last,
+                                                   (dpis or {}).get(first))
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired, RuntimeError) as e:
+                print(f"تعذر تحويل الصفحات {first}-{last} من {pdf_file.name}: {e}")
+                images = []
+            manifest.mark_rasterized(images, file_name)
+            # الصفحات التي لم تُحوّل تُسجل فاشلة فلا يُعد الملف مكتملًا ويستأنفها التشغيل التالي
+            rendered = {extract_page_number(str(img), file_name) for img in images}
+            missing = [n for n in range(first, last + 1) if n not in rendered]
+            if missing:
+                await asyncio.get_running_loop().run_in_executor(None, _mark_pages_failed, manifest, missing)
+            await asyncio.gather(*(ocr(img) for img in images))
+
+    ranges = _page_ranges(to_render, max(1, CONFIG['PIPELINE_CHUNK']), dpis)
+    await asyncio.gather(*[ocr(img) for img in ready], *[render_and_ocr(first, last) for first, last in ranges])
+    return done
+
+def process_pdf(pdf_file: Path, epoch_time: int):
+    """يقوم بتحويل ملف PDF مصور إلى نص وPDF قابل للبحث.
+    يُسجَّل التقدّم في {name}.ocr-job.json فيستأنف التشغيل بعد الانقطاع الصفحات الناقصة فقط ثم يعيد الدمج.
+    """
+    try:
+        file_name = pdf_file.stem
+        manifest = JobManifest.open(pdf_file, epoch_time)
+        folder_path = manifest.folder
+        os.makedirs(folder_path, exist_ok=True)
+
+        total_pages = count_pdf_pages(pdf_file)
+        manifest.set_total_pages(total_pages)
+        finished = manifest.finished_pages(file_name) if TESS else set()
+        if finished:
+            print(f"{len(finished)} صفحة مكتملة من تشغيل سابق، ستُعالج الصفحات الناقصة فقط.")
+        pending = [n for n in range(1, total_pages + 1) if n not in finished]
+        if CONFIG['TEXT_LAYER'] and pending:
+            text_pages = extract_text_layer_pages(pdf_file, folder_path, file_name, pending, manifest)
+            if text_pages:
+                print(f"{len(text_pages)} صفحة تحتوي طبقة نص، سيُنسخ نصها مباشرة دون OCR.")
+                finished |= set(text_pages)
+                pending = [n for n in pending if n not in finished]
+        ready = [img for img in (_page_image(folder_path, file_name, n) for n in pending) if img is not None]
+        ready_numbers = {extract_page_number(str(img), file_name) for img in ready}
+        to_render = [n for n in pending if n not in ready_numbers]
+        if CONFIG['NATIVE_IMAGES'] and TESS and to_render:
+            native = extract_native_page_images(pdf_file, folder_path, file_name, to_render, manifest)
+            if native:
+                print(f"{len(native)} صفحة صورة واحدة ستُمرّر إلى OCR بدقتها الأصلية دون تحويل.")
+                ready += native
+                native_numbers = {extract_page_number(str(img), file_name) for img in native}
+                to_render = [n for n in to_render if n not in native_numbers]
+        dpis = None
+        if CONFIG['AUTO_DPI'] and to_render:
+            dpis = choose_page_dpis(pdf_file, to_render)
+            for n, dpi in dpis.items():
+                manifest.set_page_info(n, source='render', dpi=dpi)
+            lowered = sum(1 for dpi in dpis.values() if dpi < CONFIG['DENSITY'])
+            if lowered:
+                print(f"{lowered} صفحة ستُحوّل بدقة صورتها الأصلية الأقل من {CONFIG['DENSITY']} dpi.")
+
+        if CONFIG['ASYNC_RUNNER'] and not CONFIG['IN_MEMORY'] and TESS and total_pages:
+            print(f"تحويل {pdf_file.name} وتشغيل OCR عبر asyncio ({len(pending)} من {total_pages} صفحة)...")
+            if not asyncio.run(_ocr_document_async(pdf_file, folder_path, file_name, ready, to_render, manifest, dpis)) \
+                    and not finished:
+                raise RuntimeError(f"لم يتم العثور على صور لتحويلها من {pdf_file.name}.")
+        elif (CONFIG['PIPELINE'] or CONFIG['IN_MEMORY']) and TESS and total_pages:
+            print(f"تحويل {pdf_file.name} وتشغيل OCR على دفعات ({len(pending)} من {total_pages} صفحة)...")
+            if not _ocr_pages_pipelined(pdf_file, folder_path, file_name, ready, to_render, manifest, dpis) and not finished:
+                raise RuntimeError(f"لم يتم العثور على صور لتحويلها من {pdf_file.name}.")
+        else:
+            print(f"تحويل {pdf_file.name} إلى صور...")
+            if not total_pages:
+                # تعذر عدّ الصفحات: حوّل الملف كاملًا باستدعاء واحد
+                _, images = rasterize_pdf(pdf_file, folder_path, file_name)
+                manifest.mark_rasterized(images, file_name)
+            elif to_render:
+                images = rasterize_pages_parallel(pdf_file, folder_path, file_name, to_render, dpis)
+                manifest.mark_rasterized(images, file_name)
+
+            png_files = sorted(p for p in folder_path.iterdir() if p.suffix in PAGE_IMAGE_SUFFIXES
+                               and extract_page_number(str(p), file_name) not in finished)
+            if not png_files and not finished:
+                raise RuntimeError(f"لم يتم العثور على صور لتحويلها من {pdf_file.name}.")
+
+            if not TESS:
+                print("Tesseract غير متوفر. سيتم تخطّي OCR وإنشاء الصور فقط.")
+            elif png_files:
+                if CONFIG['OCR_TUNE']:
+                    tune_ocr_split(png_files)
+                limiter = ocr_limiter()
+                print(f"تشغيل OCR على {len(png_files)} صورة (حتى {limiter.high} عملية × {limiter.threads} خيط)...")
+
+                def ocr_one(img_file: Path):
+                    with limiter:
+                        _ocr_page(img_file, file_name, manifest)
+
+                with ThreadPoolExecutor(max_workers=limiter.high) as executor:
+                    executor.map(ocr_one, png_files)
+        blank = manifest.count_pages(blank=True)
+        fallbacks = manifest.count_pages(ocr_status='fallback')
+        timeouts = manifest.count_pages(ocr_status='timeout')
+        failed = timeouts + manifest.count_pages(ocr_status='error')
+        manifest.set_summary(blank_pages=blank, fallback_pages=fallbacks, timeout_pages=timeouts)
+        manifest.save(force=True)
+        if blank:
+            print(f"تخطّى OCR {blank} صفحة فارغة في {pdf_file.name}.")
+        if fallbacks or timeouts:
+            print(f"{fallbacks} صفحة أُعيدت بإعدادات أخف بعد تجاوز المهلة، و{timeouts} صفحة بلا نص بعد تجاوزها مرتين.")
         ocred_pdfs = sorted([p for p in folder_path.iterdir() if p.suffix == '.pdf'])
         searchable_pdf_path = pdf_file.parent / f"{file_name}-قابل_للبحث.pdf"
         if ocred_pdfs:
             print("دمج ملفات PDF التي تم التعرف عليها...")
-            merge_pdfs_in_batches(ocred_pdfs, searchable_pdf_path)
+            merge_pdfs_streaming(ocred_pdfs, searchable_pdf_path)
+            if searchable_pdf_path.exists():
+                manifest.mark_merged('pdf', searchable_pdf_path)
 
-        ocred_txts = sorted([p for p in folder_path.iterdir() if p.suffix == '.txt'], key=lambda x: extract_page_number(str(x), file_name))
+        ocred_txts = sorted((extract_page_number(str(p), file_name), p)
+                            for p in folder_path.iterdir() if p.suffix == '.txt')
         txt_output_path = pdf_file.parent / f"{file_name}.txt"
-        
+
         if ocred_txts:
             print("دمج الملفات النصية التي تم التعرف عليها...")
-            with open(txt_output_path, 'w', encoding='utf-8') as outfile:
-                for txt_file in ocred_txts:
-                    page_number = extract_page_number(str(txt_file), file_name)
-                    separator = f"==============================={page_number}===============================\n"
-                    outfile.write(separator)
-                    with open(txt_file, 'r', encoding='utf-8') as infile:
-                        outfile.write(infile.read())
-                        outfile.write("\n")
-            remove_empty_lines(txt_output_path)
+            assemble_text(ocred_txts, txt_output_path)
+            manifest.mark_merged('txt', txt_output_path)
         else:
             print(f"لم يتم العثور على ملفات نصية في {folder_path.name}.")
 
-        if not CONFIG['KEEP_IMAGES']:
+        ocred_tsvs = sorted((extract_page_number(str(p), file_name), p)
+                            for p in folder_path.iterdir() if p.suffix == '.tsv')
+        if ocred_tsvs:
+            boxes_path = pdf_file.parent / f"{file_name}{WORD_BOXES_SUFFIX}"
+            pages = [(n, tsv, manifest.page_info(n).get('ocr_dpi') or manifest.page_info(n).get('dpi') or CONFIG['DENSITY'])
+                     for n, tsv in ocred_tsvs]
+            words = write_word_boxes(pages, boxes_path)
+            manifest.mark_merged('words', boxes_path)
+            print(f"حُفظت مواضع {words} كلمة في {boxes_path.name}.")
+
+        if failed:
+            # يبقى السجل والمجلد المؤقت فيستأنف التشغيل التالي الصفحات الناقصة فقط
+            print(f"{failed} صفحة بلا نواتج في {pdf_file.name}؛ أعد تشغيل التحويل لإكمالها.")
+        else:
+            manifest.finish()
+        if not CONFIG['KEEP_IMAGES'] and not failed:
             print("تنظيف الملفات المؤقتة...")
             for p in folder_path.iterdir():
                 try:
@@ -236,47 +2035,416 @@ def process_pdf(pdf_file: Path, epoch_time: int):
     except Exception as e:
         print(f"حدث خطأ أثناء معالجة الملف {pdf_file.name}: {e}")
 
-def run_ocr_to_text(directory: Path):
-    """تحويل كل ملف مصور إلى ملف نصي (ينتج TXT فقط)."""
+def worker_budget() -> int:
+    """يعيد ميزانية الخيوط الكلية المتاحة لكل عمليات OCR."""
+    return max(1, CONFIG['WORKER_BUDGET'] or os.cpu_count() or 1)
+
+def plan_batch(doc_count: int) -> Tuple[int, int]:
+    """يوزّع ميزانية الخيوط على الملفات: يعيد (عدد الملفات المتزامنة، خيوط OCR لكل ملف)."""
+    budget = worker_budget()
+    per_doc = max(1, min(CONFIG['MAX_WORKERS'], budget))
+    docs = CONFIG['DOC_WORKERS'] or max(1, budget // per_doc)
+    docs = max(1, min(docs, doc_count))
+    # إذا كانت الملفات أقل من الفتحات، وزّع الميزانية كاملة عليها
+    return docs, max(1, budget // docs)
+
+def _ocr_document_job(pdf: Path, epoch: int, keep: str, config: dict):
+    """ينفّذ process_pdf لملف واحد (قد يكون في عملية منفصلة) ثم يحذف الناتج غير المطلوب.
+    config تُطبّق على CONFIG أثناء المهمة فقط ثم تُستعاد القيم السابقة، لأن المهمة قد تعمل في العملية الرئيسية.
+    """
+    previous = {k: CONFIG[k] for k in config if k in CONFIG}
+    CONFIG.update(config)
+    try:
+        process_pdf(pdf, epoch)
+    finally:
+        CONFIG.update(previous)
+    boxes = pdf.with_name(f"{pdf.stem}{WORD_BOXES_SUFFIX}")
+    if keep == 'txt':
+        # مواضع الكلمات تشير إلى صفحات PDF القابل للبحث، فيبقى معها ليظلل العارض نتائج البحث
+        unwanted = [] if boxes.exists() else [pdf.with_name(f"{pdf.stem}-قابل_للبحث.pdf")]
+    else:
+        # بلا نص ولا فهرس لا يقرأ أحد ملف المواضع
+        unwanted = [pdf.with_suffix(".txt"), page_index_path(pdf.with_suffix(".txt")), boxes]
+    for path in unwanted:
+        if path.exists():
+            try:
+                path.unlink()
+            except OSError as e:
+                print(f"فشل حذف الملف المؤقت {path.name}: {e}")
+
+def _run_ocr_batch(directory: Path, keep: str):
+    """يشغّل OCR على كل ملفات المجلد، عدة ملفات في وقت واحد ضمن ميزانية خيوط مشتركة.
+    keep: 'txt' للإبقاء على الملف النصي (ومعه PDF القابل للبحث إن حُفظت مواضع الكلمات)،
+    'pdf' للإبقاء على PDF القابل للبحث فقط.
+    """
     epoch = int(calendar.timegm(time.gmtime()))
     pdfs = list_pdfs(directory)
     if not pdfs:
         print("لا توجد ملفات PDF في المجلد الحالي.")
         return
-    for pdf in pdfs:
-        print(f"بدء تحويل {pdf.name} إلى نص...")
-        try:
-            process_pdf(pdf, epoch)
-            searchable_pdf = pdf.with_name(f"{pdf.stem}-قابل_للبحث.pdf")
-            if searchable_pdf.exists():
+    if keep == 'txt':
+        start_msg, done_msg, fail_msg = "إلى نص", "حُوّل إلى نص: {} -> {}.txt", "فشل التحويل إلى نص للملف {}: {}"
+    else:
+        start_msg, done_msg, fail_msg = "إلى PDF قابل للبحث", "حُوّل إلى كتاب قابل للبحث: {} -> {}-قابل_للبحث.pdf", "فشل التحويل إلى كتاب قابل للبحث للملف {}: {}"
+
+    docs, per_doc = plan_batch(len(pdfs))
+    if docs == 1:
+        for pdf in pdfs:
+            print(f"بدء تحويل {pdf.name} {start_msg}...")
+            try:
+                _ocr_document_job(pdf, epoch, keep, {'MAX_WORKERS': per_doc})
+                print(done_msg.format(pdf.name, pdf.stem))
+            except Exception as e:
+                print(fail_msg.format(pdf.name, e))
+    else:
+        print(f"معالجة {len(pdfs)} ملفًا: {docs} ملفات في وقت واحد × {per_doc} خيوط OCR لكل ملف.")
+        config = dict(CONFIG, MAX_WORKERS=per_doc)  # العمليات الفرعية لا ترث تعديلات CONFIG في كل الأنظمة
+        with ProcessPoolExecutor(max_workers=docs) as executor:
+            futures = {}
+            for pdf in pdfs:
+                print(f"بدء تحويل {pdf.name} {start_msg}...")
+                futures[executor.submit(_ocr_document_job, pdf, epoch, keep, config)] = pdf
+            for fut in as_completed(futures):
+                pdf = futures[fut]
                 try:
-                    searchable_pdf.unlink()
-                except OSError as e:
-                    print(f"فشل حذف PDF القابل للبحث المؤقت: {e}")
-            print(f"حُوّل إلى نص: {pdf.name} -> {pdf.stem}.txt")
-        except Exception as e:
-            print(f"فشل التحويل إلى نص للملف {pdf.name}: {e}")
+                    fut.result()
+                    print(done_msg.format(pdf.name, pdf.stem))
+                except Exception as e:
+                    print(fail_msg.format(pdf.name, e))
+
+    # الفهرسة في العملية الرئيسية فقط حتى لا تتزاحم العمليات على ملف SQLite
+    if keep == 'txt' and CONFIG['INDEX_AFTER_OCR']:
+        index_library(directory, [pdf.with_suffix(".txt") for pdf in pdfs])
+
+def run_ocr_to_text(directory: Path):
+    """تحويل كل ملف مصور إلى ملف نصي مفهرس للبحث (ومعه PDF القابل للبحث لتظليل النتائج إن طُلب TSV)."""
+    _run_ocr_batch(directory, keep='txt')
 
 def run_ocr_to_searchable_pdf(directory: Path):
     """تحويل كل ملف مصور إلى كتاب قابل للبحث (ينتج PDF فقط)."""
-    epoch = int(calendar.timegm(time.gmtime()))
-    pdfs = list_pdfs(directory)
-    if not pdfs:
-        print("لا توجد ملفات PDF في المجلد الحالي.")
-        return
-    for pdf in pdfs:
-        print(f"بدء تحويل {pdf.name} إلى PDF قابل للبحث...")
+    _run_ocr_batch(directory, keep='pdf')
+
+# ===================== فهرس البحث في النصوص =====================
+# تشكيل وحركات قرآنية وتطويل تُحذف قبل الفهرسة والبحث
+_ARABIC_MARKS = re.compile("[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]")
+_ARABIC_FOLD = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه"})
+_PAGE_SEPARATOR = re.compile(r"^=+(\d+)=+$")
+_STOPWORDS: Optional[frozenset] = None
+
+def normalize_arabic(text: str) -> str:
+    """توحيد النص للبحث: حذف التشكيل والتطويل، وتوحيد الألف والياء والتاء المربوطة، وأرقام لاتينية وأحرف صغيرة."""
+    return _ARABIC_MARKS.sub("", normalize_digits(text)).translate(_ARABIC_FOLD).lower()
+
+def load_stopwords() -> frozenset:
+    """يحمّل stopwords.txt المرفق (بعد التوحيد) مرة واحدة. العبارات متعددة الكلمات تُتجاهل."""
+    global _STOPWORDS
+    if _STOPWORDS is None:
+        words = set()
         try:
-            process_pdf(pdf, epoch)
-            txt_path = pdf.with_suffix(".txt")
-            if txt_path.exists():
-                try:
-                    txt_path.unlink()
-                except OSError as e:
-                    print(f"فشل حذف الملف النصي المؤقت: {e}")
-            print(f"حُوّل إلى كتاب قابل للبحث: {pdf.name} -> {pdf.stem}-قابل_للبحث.pdf")
-        except Exception as e:
-            print(f"فشل التحويل إلى كتاب قابل للبحث للملف {pdf.name}: {e}")
+            with open(Path(__file__).resolve().parent / "stopwords.txt", "r", encoding="utf-8") as f:
+                for line in f:
+                    word = normalize_arabic(line.strip())
+                    if word and " " not in word:
+                        words.add(word)
+        except OSError as e:
+            print(f"تعذر قراءة stopwords.txt: {e}. الفهرسة دون كلمات مستبعدة.")
+        _STOPWORDS = frozenset(words)
+    return _STOPWORDS
+
+def tokenize(text: str) -> List[str]:
+    """يقسم النص الموحّد إلى كلمات مع استبعاد الكلمات الشائعة والأحرف المفردة."""
+    stopwords = load_stopwords()
+    return [w for w in re.findall(r"\w+", normalize_arabic(text)) if len(w) > 1 and w not in stopwords]
+
+def iter_text_pages(txt_path: Path) -> Iterable[Tuple[int, str]]:
+    """يقرأ ملف نص كتاب (بفواصل =====N=====) صفحةً صفحة دون تحميله كاملًا. يعيد (رقم الصفحة، نصها)."""
+    page, lines = None, []
+    with open(txt_path, "r", encoding="utf-8") as f:
+        for line in f:
+            m = _PAGE_SEPARATOR.match(line.strip())
+            if m:
+                if page is not None:
+                    yield page, "".join(lines)
+                page, lines = int(m.group(1)), []
+            elif page is not None:
+                lines.append(line)
+    if page is not None:
+        yield page, "".join(lines)
+
+class SearchIndex:
+    """فهرس مقلوب على القرص (SQLite): كلمة موحّدة -> (كتاب، صفحة، تكرار).
+    المفتاح الأساسي يبدأ بالكلمة فيكون البحث قراءة مباشرة من الفهرس مهما كبرت المكتبة.
+    جدول documents يحفظ حجم كل ملف ووقت تعديله وبصمته، فتُعاد فهرسة الكتب الجديدة أو المتغيرة فقط.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn = sqlite3.connect(str(path))
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, name TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL, doc_id INTEGER NOT NULL, page INTEGER NOT NULL, count INTEGER NOT NULL,
+                PRIMARY KEY (term, doc_id, page)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+        """)
+        # فهارس أُنشئت قبل الفهرسة التزايدية لا تحتوي أعمدة البصمة
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(documents)")}
+        for column, kind in (("size", "INTEGER"), ("mtime_ns", "INTEGER"), ("sha256", "TEXT")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE documents ADD COLUMN {column} {kind}")
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _doc_id(self, txt_path: Path) -> Optional[int]:
+        row = self._conn.execute("SELECT id FROM documents WHERE path = ?", (str(txt_path.resolve()),)).fetchone()
+        return row[0] if row else None
+
+    def remove_document(self, txt_path: Path) -> None:
+        """يحذف كتابًا وكل مدخلاته من الفهرس."""
+        doc_id = self._doc_id(txt_path)
+        if doc_id is not None:
+            with self._conn:
+                self._conn.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+                self._conn.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+
+    def is_current(self, txt_path: Path) -> bool:
+        """هل فهرسة الكتاب مطابقة لملفه الحالي؟ الحجم ووقت التعديل يكفيان غالبًا؛
+        إن اختلفا تُقارن البصمة (ملف لُمس دون تغيير لا يُعاد فهرسته) ويُحدّث وقت التعديل المحفوظ.
+        """
+        row = self._conn.execute("SELECT id, size, mtime_ns, sha256 FROM documents WHERE path = ?",
+                                 (str(txt_path.resolve()),)).fetchone()
+        if row is None:
+            return False
+        doc_id, size, mtime_ns, digest = row
+        st = txt_path.stat()
+        if (size, mtime_ns) == (st.st_size, st.st_mtime_ns):
+            return True
+        if digest is None or size != st.st_size or file_sha256(txt_path) != digest:
+            return False
+        with self._conn:
+            self._conn.execute("UPDATE documents SET mtime_ns = ? WHERE id = ?", (st.st_mtime_ns, doc_id))
+        return True
+
+    def book_count(self) -> int:
+        """عدد الكتب التي لها صفحات مفهرسة."""
+        return self._conn.execute("SELECT COUNT(DISTINCT doc_id) FROM postings").fetchone()[0]
+
+    def documents(self) -> List[Path]:
+        """مسارات كل الكتب المفهرسة."""
+        return [Path(row[0]) for row in self._conn.execute("SELECT path FROM documents")]
+
+    def add_document(self, txt_path: Path) -> int:
+        """يفهرس ملف نص كتاب (يستبدل فهرسته السابقة إن وُجدت). يعيد عدد الصفحات المفهرسة."""
+        self.remove_document(txt_path)
+        st = txt_path.stat()
+        digest = file_sha256(txt_path)
+        pages = 0
+        with self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO documents (path, name, size, mtime_ns, sha256) VALUES (?, ?, ?, ?, ?)",
+                (str(txt_path.resolve()), txt_path.stem, st.st_size, st.st_mtime_ns, digest))
+            doc_id = cur.lastrowid
+            for page, text in iter_text_pages(txt_path):
+                counts: dict = {}
+                for word in tokenize(text):
+                    counts[word] = counts.get(word, 0) + 1
+                self._conn.executemany("INSERT INTO postings (term, doc_id, page, count) VALUES (?, ?, ?, ?)",
+                                       ((term, doc_id, page, n) for term, n in counts.items()))
+                pages += 1
+        return pages
+
+    def search(self, query: str, limit: int = 50) -> List[Tuple[str, int, int]]:
+        """يعيد الصفحات التي تحتوي كل كلمات الاستعلام: (اسم الكتاب، رقم الصفحة، مجموع التكرار) مرتبة بالأكثر تكرارًا."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        marks = ",".join("?" * len(terms))
+        rows = self._conn.execute(f"""
+            SELECT d.name, p.page, SUM(p.count) AS score
+            FROM postings p JOIN documents d ON d.id = p.doc_id
+            WHERE p.term IN ({marks})
+            GROUP BY p.doc_id, p.page
+            HAVING COUNT(*) = ?
+            ORDER BY score DESC, d.name, p.page
+            LIMIT ?""", (*terms, len(terms), limit)).fetchall()
+        return [(name, page, score) for name, page, score in rows]
+
+# ملف مواضع الكلمات {name}.words.bin بجانب ناتج OCR، بتخطيط عمودي مضغوط (little-endian):
+#   ترويسة: OCRW، الإصدار (H)، عدد الصفحات (I)، عدد الكلمات (I)
+#   جدول الصفحات: رقم الصفحة، الدقة، ارتفاع الصورة بالبكسل، أول كلمة، عدد الكلمات (5I لكل صفحة)
+#   أعمدة الكلمات: left[] top[] width[] height[] (I)، ثم بداية كل كلمة في النص (I، عدد الكلمات + 1)،
+#   ثم الكلمات الموحّدة UTF-8 متتالية.
+WORD_BOXES_SUFFIX = ".words.bin"
+_WORD_BOXES_MAGIC = b"OCRW"
+_WORD_BOXES_HEADER = struct.Struct("<4sHII")
+_WORD_BOXES_PAGE = struct.Struct("<5I")
+
+def _packed(values: List[int]) -> bytes:
+    arr = array.array("I", values)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tobytes()
+
+def _unpacked(data: bytes, offset: int, count: int) -> array.array:
+    arr = array.array("I")
+    arr.frombytes(data[offset:offset + 4 * count])
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+def parse_tesseract_tsv(tsv_path: Path) -> Tuple[int, List[Tuple[str, int, int, int, int]]]:
+    """يقرأ ملف TSV من Tesseract: يعيد (ارتفاع الصورة بالبكسل، [(الكلمة الموحّدة، left، top، width، height)])."""
+    height, words = 0, []
+    with open(tsv_path, "r", encoding="utf-8") as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) < 12 or not cols[0].isdigit():
+                continue  # سطر العناوين أو سطر تالف
+            level = int(cols[0])
+            left, top, width, h = (int(c) for c in cols[6:10])
+            if level == 1:
+                height = h
+            elif level == 5:
+                word = "".join(re.findall(r"\w+", normalize_arabic(cols[11])))
+                if word:
+                    words.append((word, left, top, width, h))
+    return height, words
+
+def write_word_boxes(pages: List[Tuple[int, Path, int]], out_path: Path) -> int:
+    """يجمع مواضع كلمات صفحات كتاب من ملفات TSV (رقم الصفحة، الملف، الدقة) في ملف واحد. يعيد عدد الكلمات."""
+    table, columns, offsets, texts = [], ([], [], [], []), [0], []
+    for number, tsv, dpi in pages:
+        try:
+            height, words = parse_tesseract_tsv(tsv)
+        except (OSError, ValueError) as e:
+            print(f"تعذر قراءة مواضع الكلمات من {tsv.name}: {e}")
+            continue
+        table.append((number, dpi, height, len(offsets) - 1, len(words)))
+        for word, *box in words:
+            for column, value in zip(columns, box):
+                column.append(value)
+            encoded = word.encode("utf-8")
+            texts.append(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+    count = len(offsets) - 1
+    tmp = out_path.with_name(f".{out_path.name}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(_WORD_BOXES_HEADER.pack(_WORD_BOXES_MAGIC, 1, len(table), count))
+        for row in table:
+            f.write(_WORD_BOXES_PAGE.pack(*row))
+        for column in columns:
+            f.write(_packed(column))
+        f.write(_packed(offsets))
+        f.write(b"".join(texts))
+    os.replace(tmp, out_path)
+    return count
+
+class WordBoxes:
+    """قارئ ملف مواضع الكلمات: يعيد مستطيل كل كلمة بنقاط PDF (أصل الإحداثيات أسفل يسار الصفحة)
+    كما في صفحات قابل_للبحث التي ينشئها Tesseract بحجم الصورة ÷ الدقة.
+    """
+
+    def __init__(self, path: Path):
+        data = path.read_bytes()
+        magic, version, page_count, count = _WORD_BOXES_HEADER.unpack_from(data, 0)
+        if magic != _WORD_BOXES_MAGIC or version != 1:
+            raise ValueError(f"ملف مواضع كلمات غير مدعوم: {path.name}")
+        pos = _WORD_BOXES_HEADER.size
+        self.pages = {}
+        for _ in range(page_count):
+            number, dpi, height, first, n = _WORD_BOXES_PAGE.unpack_from(data, pos)
+            self.pages[number] = (dpi, height, first, n)
+            pos += _WORD_BOXES_PAGE.size
+        self._left, self._top, self._width, self._height = (_unpacked(data, pos + 4 * count * i, count) for i in range(4))
+        pos += 16 * count
+        self._offsets = _unpacked(data, pos, count + 1)
+        self._text = data[pos + 4 * (count + 1):]
+
+    def word(self, i: int) -> str:
+        return self._text[self._offsets[i]:self._offsets[i + 1]].decode("utf-8")
+
+    def find(self, page: int, terms: Iterable[str]) -> List[Tuple[float, float, float, float]]:
+        """مستطيلات (x0, y0, x1, y1) بنقاط PDF لكلمات الصفحة المطابقة لأي من الكلمات الموحّدة المعطاة."""
+        if page not in self.pages:
+            return []
+        wanted = set(terms)
+        dpi, height, first, n = self.pages[page]
+        scale = 72.0 / (dpi or CONFIG['DENSITY'])
+        boxes = []
+        for i in range(first, first + n):
+            if self.word(i) in wanted:
+                left, top, width, h = self._left[i], self._top[i], self._width[i], self._height[i]
+                boxes.append((round(left * scale, 2), round((height - top - h) * scale, 2),
+                              round((left + width) * scale, 2), round((height - top) * scale, 2)))
+        return boxes
+
+def search_with_boxes(directory: Path, query: str, limit: int = 50) -> List[Tuple[str, int, Tuple[float, float, float, float]]]:
+    """يبحث في فهرس المجلد ويعيد (الكتاب، الصفحة، مستطيل الكلمة بنقاط PDF) لكل موضع مطابق
+    يمكن للعارض تظليله مباشرة في {الكتاب}-قابل_للبحث.pdf. الصفحات بلا ملف مواضع تُعاد بمستطيل فارغ.
+    """
+    terms = set(tokenize(query))
+    results = []
+    readers: dict = {}
+    with SearchIndex(directory / CONFIG['INDEX_FILE']) as index:
+        hits = index.search(query, limit)
+    for name, page, _ in hits:
+        if name not in readers:
+            path = directory / f"{name}{WORD_BOXES_SUFFIX}"
+            try:
+                readers[name] = WordBoxes(path) if path.exists() else None
+            except (OSError, ValueError, struct.error) as e:
+                print(f"تعذر قراءة {path.name}: {e}")
+                readers[name] = None
+        boxes = readers[name].find(page, terms) if readers[name] is not None else []
+        if boxes:
+            results.extend((name, page, box) for box in boxes)
+        else:
+            results.append((name, page, ()))
+    return results
+
+def index_library(directory: Path, txt_files: Optional[List[Path]] = None) -> int:
+    """يحدّث فهرس المجلد تزايديًا: يفهرس الكتب الجديدة أو المتغيرة فقط ويتخطى غير المتغيرة.
+    دون txt_files يُفحص كل ملف .txt في المجلد وتُحذف من الفهرس الكتب التي حُذفت ملفاتها.
+    يعيد عدد الكتب المفهرسة في الفهرس بعد التحديث.
+    """
+    full_scan = txt_files is None
+    if full_scan:
+        txt_files = sorted(p for p in directory.glob("*.txt") if p.name != "stopwords.txt")
+    added = skipped = removed = 0
+    with SearchIndex(directory / CONFIG['INDEX_FILE']) as index:
+        if full_scan:
+            for path in index.documents():
+                if not path.exists():
+                    index.remove_document(path)
+                    removed += 1
+        for txt in txt_files:
+            if not txt.exists():
+                continue
+            try:
+                if index.is_current(txt):
+                    skipped += 1
+                    continue
+                pages = index.add_document(txt)
+            except (OSError, UnicodeDecodeError, sqlite3.Error) as e:
+                print(f"تعذر فهرسة {txt.name}: {e}")
+                continue
+            # ملفات بلا فواصل صفحات (ليست نصوص كتب) تبقى مسجلة دون مدخلات حتى لا يُعاد فحصها
+            if pages:
+                added += 1
+                print(f"فُهرس {txt.name}: {pages} صفحة.")
+        total = index.book_count()
+    print(f"تحديث الفهرس: {added} كتاب جديد أو متغير، {skipped} دون تغيير، {removed} محذوف.")
+    return total
 
 # ===================== أدوات مساعدة لـ PDFService =====================
 ARABIC_DIGIT_MAP = str.maketrans(
@@ -452,6 +2620,95 @@ class PDFDocument:
             self.writer_from_indices(range(mid, self.total_pages)),
         )
 
+class LazyPDFDocument:
+    """وثيقة PDF لا تحلل إلا ما تحتاجه عمليات الصفحات البسيطة (الاستخراج والحذف).
+    عدد الصفحات يُقرأ من /Count في جذر الشجرة، والصفحات المختارة تُجمع بمسح واحد للشجرة
+    عبر /Kids و/Count يتخطى الفروع غير المطلوبة، ثم تُنسخ الكائنات المتصلة بتلك الصفحات وحدها
+    إلى الملف الناتج بتمريرة واحدة عبر StreamingPDFMerger.
+    الملفات المشفرة تُرفض هنا ليعود المستدعي إلى PDFDocument.
+    """
+    # خصائص تُورث من عقد /Pages إلى الصفحات إن لم تحددها الصفحة نفسها
+    INHERITABLE = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+    def __init__(self, source: PDFSource):
+        self.source = source
+        self.reader: Optional[PdfReader] = None
+        self.total_pages: int = 0
+        self.base_name: str = self.source.path.stem
+
+    def load(self) -> None:
+        """يقرأ جدول xref والجذر فقط؛ الكائنات تُحل عند الطلب."""
+        self.reader = PdfReader(str(self.source.path), strict=False)
+        if self.reader.is_encrypted:
+            raise PermissionError("الملف مشفّر؛ يلزم التحميل الكامل.")
+        self.total_pages = int(self.reader.trailer["/Root"]["/Pages"]["/Count"])
+
+    def pages(self, indices: Iterable[int]) -> List[Tuple[DictionaryObject, Optional[IndirectObject]]]:
+        """يعيد قواميس الصفحات المحددة (مع الخصائص الموروثة) ومراجعها بترتيب indices.
+        الشجرة تُمسح مرة واحدة بالترتيب، وتُتخطى الفروع التي لا تحتوي صفحة مطلوبة بقراءة /Count فقط.
+        """
+        if self.reader is None:
+            raise RuntimeError("يجب استدعاء load() أولاً لتحميل المستند.")
+        wanted = [i for i in indices if 0 <= i < self.total_pages]
+        if not wanted:
+            return []
+        found: dict = {}
+        self._collect(self.reader.trailer["/Root"]["/Pages"], None, 0, {}, sorted(set(wanted)), found, set())
+        missing = [i + 1 for i in wanted if i not in found]
+        if missing:
+            raise ValueError(f"شجرة صفحات غير مألوفة: لم يُعثر على الصفحات {missing[:5]}.")
+        return [found[i] for i in wanted]
+
+    def _collect(self, node: DictionaryObject, ref: Optional[IndirectObject], start: int, inherited: dict,
+                 targets: List[int], found: dict, seen: set) -> None:
+        """ينزل في العقدة node التي تبدأ صفحاتها عند start ويجمع الصفحات المطلوبة منها في found."""
+        inherited = dict(inherited)
+        for k in self.INHERITABLE:
+            if k in node:
+                inherited[k] = dict.__getitem__(node, k)
+        if "/Kids" not in node:
+            page = DictionaryObject(dict.items(node))
+            for k, v in inherited.items():
+                if k not in page:
+                    page[NameObject(k)] = v
+            found[start] = (page, ref)
+            return
+        kids = node["/Kids"]
+        end = start + len(kids)
+        hits = targets[bisect.bisect_left(targets, start):bisect.bisect_left(targets, end)]
+        if "/Count" in node and int(node["/Count"]) == len(kids):
+            # كل الأبناء صفحات (الشجرة المسطحة الشائعة): الوصول المباشر بالفهرس دون قراءة الإخوة
+            leaves = []
+            for t in hits:
+                kid_ref = kids[t - start]
+                kid = kid_ref.get_object() if isinstance(kid_ref, IndirectObject) else None
+                if kid is None or "/Kids" in kid:
+                    break
+                leaves.append((t, kid_ref, kid))
+            else:
+                for t, kid_ref, kid in leaves:
+                    self._collect(kid, kid_ref, t, inherited, targets, found, seen)
+                return
+        for kid_ref in kids:
+            if start > targets[-1]:
+                break
+            if not isinstance(kid_ref, IndirectObject) or kid_ref.idnum in seen:
+                raise ValueError("شجرة صفحات غير مألوفة.")
+            seen.add(kid_ref.idnum)
+            kid = kid_ref.get_object()
+            count = int(kid["/Count"]) if "/Kids" in kid else 1
+            pos = bisect.bisect_left(targets, start)
+            if pos < len(targets) and targets[pos] < start + count:
+                self._collect(kid, kid_ref, start, inherited, targets, found, seen)
+            start += count
+
+    def write_pages(self, indices: Iterable[int], out_path: Path) -> Path:
+        """يكتب الصفحات المحددة إلى ملف جديد دون تحميل بقية الوثيقة."""
+        pages = self.pages(indices)
+        with StreamingPDFMerger(out_path) as merger:
+            merger.append_page_objects(pages)
+        return out_path
+
 class PDFExporter:
     """يتعامل مع حفظ كُتاب PDF إلى ملفات."""
     def __init__(self, out_dir: Path = Path(".")):
@@ -500,6 +2757,25 @@ class PDFService:
         doc.load()
         return doc
 
+    def _open_lazy(self) -> Optional[LazyPDFDocument]:
+        """يفتح أول ملف PDF بالطريقة الكسولة، أو يعيد None إن كان مشفرًا أو غير مألوف."""
+        doc = LazyPDFDocument(PDFSource.first_in_dir(self.directory))
+        try:
+            doc.load()
+        except Exception:
+            return None
+        return doc
+
+    def _export_pages(self, doc, indices: List[int], out: Path) -> Path:
+        """يحفظ الصفحات المحددة؛ بالنسخ المتدفق إن أمكن وإلا عبر PdfWriter."""
+        if isinstance(doc, LazyPDFDocument):
+            try:
+                return doc.write_pages(indices, out)
+            except Exception as e:
+                print(f"تعذر النسخ المباشر للصفحات ({e}). الرجوع إلى التحميل الكامل...")
+                doc = self._open_first()
+        return PDFExporter(self.directory).export_writer(doc.writer_from_indices(indices), out)
+
     def split_halves(self) -> Tuple[Path, Path]:
         """يقسم أول ملف PDF في المجلد إلى نصفين."""
         doc = self._open_first()
@@ -510,24 +2786,22 @@ class PDFService:
 
     def extract_pages(self, pages_spec: str) -> Path:
         """يستخرج صفحات محددة من أول ملف PDF في المجلد."""
-        doc = self._open_first()
+        doc = self._open_lazy() or self._open_first()
         idx = parse_pages(pages_spec, doc.total_pages)
         if not idx:
             raise ValueError("لا توجد صفحات صالحة للاستخراج من المواصفات المقدمة.")
-        w = doc.writer_from_indices(idx)
         out = self.directory / f"{doc.base_name}-صفحات-{pages_spec.replace(' ','')}.pdf"
-        return PDFExporter(self.directory).export_writer(w, out)
+        return self._export_pages(doc, idx, out)
 
     def delete_pages(self, pages_spec: str) -> Path:
         """يحذف صفحات محددة من أول ملف PDF في المجلد."""
-        doc = self._open_first()
+        doc = self._open_lazy() or self._open_first()
         del_idx = set(parse_pages(pages_spec, doc.total_pages))
         keep = [i for i in range(doc.total_pages) if i not in del_idx]
         if not keep:
             raise ValueError("لا يمكن حذف كل الصفحات. سيصبح الملف الناتج فارغًا.")
-        w = doc.writer_from_indices(keep)
         out = self.directory / f"{doc.base_name}-بعد_الحذف-{pages_spec.replace(' ','')}.pdf"
-        return PDFExporter(self.directory).export_writer(w, out)
+        return self._export_pages(doc, keep, out)
 
     def merge_all(self, out_name: str = "الكل-مدمج.pdf", overwrite: bool = True) -> Path:
         """يدمج جميع ملفات PDF في المجلد الحالي بترتيب طبيعي."""
@@ -617,61 +2891,195 @@ def open_image_rgb_fixed(path: Path, bg: Tuple[int,int,int] | None=(255,255,255)
         img = img.convert("RGB") # تحويل أي وضع آخر إلى RGB
     return img
 
-def convert_each_to_pdf(folder: Path):
-    """يحول كل ملف صورة في المجلد إلى ملف PDF منفصل."""
-    # مرشحات الملفات لتضمينها كصور
-    image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".webp"}
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".webp", ".jp2", ".j2k", ".jpx"}
+
+# اتجاهات EXIF التي تعادل تدويرًا صافيًا (بلا انعكاس) -> قيمة /Rotate في PDF
+_EXIF_ROTATE = {1: 0, 3: 180, 6: 90, 8: 270}
+
+@dataclass
+class EncodedImage:
+    """صورة مرمّزة جاهزة للتضمين في PDF كما هي (DCTDecode/JPXDecode)."""
+    data: bytes
+    width: int
+    height: int
+    filter: str
+    colorspace: Optional[str] = None
+    bits: Optional[int] = 8
+    rotate: int = 0
+
+def passthrough_image(path: Path) -> Optional[EncodedImage]:
+    """يعيد بايتات JPEG/JPEG2000 الأصلية مع أبعادها إن أمكن تضمينها دون إعادة ترميز، وإلا None.
+    يُقرأ رأس الصورة فقط. تُستبعد CMYK والاتجاهات المعكوسة في EXIF لأنها تحتاج فك الترميز.
+    """
+    try:
+        with Image.open(path) as im:
+            fmt, mode, (width, height) = im.format, im.mode, im.size
+            orientation = im.getexif().get(0x0112, 1) if fmt == "JPEG" else 1
+    except Exception:
+        return None
+    rotate = _EXIF_ROTATE.get(orientation)
+    if rotate is None:
+        return None
+    if fmt == "JPEG" and mode in ("L", "RGB"):
+        colorspace = "/DeviceGray" if mode == "L" else "/DeviceRGB"
+        return EncodedImage(path.read_bytes(), width, height, "/DCTDecode", colorspace, 8, rotate)
+    if fmt == "JPEG2000":
+        # JPXDecode يحمل فضاء اللون وعمق البت داخل الترميز نفسه
+        return EncodedImage(path.read_bytes(), width, height, "/JPXDecode", None, None)
+    return None
+
+class ImagePDFWriter(StreamingPDFMerger):
+    """يكتب PDF صفحة صورة تلو الأخرى إلى القرص مباشرة؛ لا تبقى في الذاكرة إلا الصورة الحالية."""
+
+    def add_encoded_image(self, image: EncodedImage, resolution: float) -> None:
+        """يضيف صفحة تحتوي صورة مرمّزة كما هي، بحجم يطابق أبعادها بالدقة المعطاة."""
+        xobj = EncodedStreamObject()
+        xobj._data = image.data
+        xobj.update({
+            NameObject("/Type"): NameObject("/XObject"),
+            NameObject("/Subtype"): NameObject("/Image"),
+            NameObject("/Width"): NumberObject(image.width),
+            NameObject("/Height"): NumberObject(image.height),
+            NameObject("/Filter"): NameObject(image.filter),
+        })
+        if image.colorspace:
+            xobj[NameObject("/ColorSpace")] = NameObject(image.colorspace)
+        if image.bits:
+            xobj[NameObject("/BitsPerComponent")] = NumberObject(image.bits)
+        xobj_num = self._reserve()
+        self._write_raw(xobj_num, self._serialize(xobj))
+
+        w_pt = image.width * 72.0 / resolution
+        h_pt = image.height * 72.0 / resolution
+        content = DecodedStreamObject()
+        content._data = f"q {w_pt:.4f} 0 0 {h_pt:.4f} 0 0 cm /Im0 Do Q".encode("ascii")
+        content_num = self._reserve()
+        self._write_raw(content_num, self._serialize(content))
+
+        page = DictionaryObject({
+            NameObject("/Type"): NameObject("/Page"),
+            NameObject("/Parent"): IndirectObject(self._pages_root, 0, None),
+            NameObject("/MediaBox"): ArrayObject([NumberObject(0), NumberObject(0), FloatObject(f"{w_pt:.4f}"), FloatObject(f"{h_pt:.4f}")]),
+            NameObject("/Resources"): DictionaryObject({
+                NameObject("/XObject"): DictionaryObject({NameObject("/Im0"): IndirectObject(xobj_num, 0, None)}),
+            }),
+            NameObject("/Contents"): IndirectObject(content_num, 0, None),
+        })
+        if image.rotate:
+            page[NameObject("/Rotate")] = NumberObject(image.rotate)
+        page_num = self._reserve()
+        self._write_raw(page_num, self._serialize(page))
+        self._kids.append(page_num)
+
+def encode_image_for_pdf(path: Path) -> EncodedImage:
+    """يجهّز صورة لصفحة PDF: تمرير JPEG/JPEG2000 كما هي إن أمكن، وإلا فك الترميز وتطبيعها
+    عبر open_image_rgb_fixed ثم ترميزها JPEG في الذاكرة (كما يفعل Pillow عند الحفظ إلى PDF).
+    """
+    if CONFIG['IMAGE_PASSTHROUGH']:
+        encoded = passthrough_image(path)
+        if encoded is not None:
+            return encoded
+    img = open_image_rgb_fixed(path)
+    try:
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=CONFIG['IMAGE_JPEG_QUALITY'])
+        return EncodedImage(buf.getvalue(), img.width, img.height, "/DCTDecode", "/DeviceRGB", 8)
+    finally:
+        img.close()
+
+def _iter_encoded_images(files: List[Path], workers: int) -> Iterable[Tuple[Path, Optional[EncodedImage], Optional[Exception]]]:
+    """يرمّز الصور بالترتيب، بالتوازي عند طلب خيوط، مع نافذة محدودة من الصور قيد المعالجة
+    حتى تبقى الذاكرة بحجم بضع صفحات مهما كبر المجلد.
+    """
+    def encode(f: Path):
+        try:
+            return f, encode_image_for_pdf(f), None
+        except Exception as e:
+            return f, None, e
+
+    if workers <= 1:
+        for f in files:
+            yield encode(f)
+        return
+    window: "queue.Queue" = queue.Queue()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        it = iter(files)
+        for f in it:
+            window.put(executor.submit(encode, f))
+            if window.qsize() >= workers * 2:
+                break
+        while not window.empty():
+            yield window.get().result()
+            nxt = next(it, None)
+            if nxt is not None:
+                window.put(executor.submit(encode, nxt))
+
+def _list_images(folder: Path) -> Optional[List[Path]]:
+    """يسرد ملفات الصور في المجلد بترتيب طبيعي، أو None عند غياب الصلاحيات."""
     try:
-        files = [p for p in folder.iterdir() if p.is_file() and p.suffix.lower() in image_extensions]
+        files = [p for p in folder.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS]
     except PermissionError:
         print("لا صلاحيات للوصول إلى هذا المجلد. امنح الصلاحيات اللازمة من إعدادات الخصوصية في macOS.")
-        return
+        return None
     files.sort(key=lambda p: natural_key(p.name))
+    return files
+
+def convert_each_to_pdf(folder: Path):
+    """يحول كل ملف صورة في المجلد إلى ملف PDF منفصل.
+    ملفات JPEG/JPEG2000 تُضمّن كما هي (IMAGE_PASSTHROUGH) دون فقد جودة إضافي.
+    """
+    files = _list_images(folder)
+    if files is None:
+        return
     count = 0
     for f in files:
         try:
-            img = open_image_rgb_fixed(f)
             out = folder / f"{f.stem}.pdf"
-            img.save(out, "PDF", resolution=300) # حفظ بدقة 300dpi
-            img.close()
+            encoded = passthrough_image(f) if CONFIG['IMAGE_PASSTHROUGH'] else None
+            if encoded is not None:
+                with ImagePDFWriter(out) as writer:
+                    writer.add_encoded_image(encoded, CONFIG['IMAGE_DPI'])
+            else:
+                img = open_image_rgb_fixed(f)
+                img.save(out, "PDF", resolution=CONFIG['IMAGE_DPI'])
+                img.close()
             count += 1
         except Exception as e:
             print(f"فشل تحويل الصورة {f.name} إلى PDF: {e}")
             continue
     print(f"تم تحويل {count} صورة إلى ملفات PDF منفصلة في {folder.name}")
 
+def _merge_images_streaming(files: List[Path], out_path: Path) -> int:
+    """يكتب الصور إلى PDF واحد صفحةً صفحة؛ الذاكرة بحجم صفحة (أو نافذة الخيوط) لا بحجم المجلد."""
+    count = 0
+    with ImagePDFWriter(out_path) as writer:
+        for f, encoded, error in _iter_encoded_images(files, CONFIG['IMAGE_WORKERS']):
+            if error is not None:
+                print(f"فشل تحميل الصورة {f.name} للدمج: {error}")
+                continue
+            writer.add_encoded_image(encoded, CONFIG['IMAGE_DPI'])
+            count += 1
+    return count
+
 def merge_all_to_pdf(folder: Path, out_name: str = "الصور-مدمجة.pdf"):
-    """يدمج جميع ملفات الصور في المجلد إلى ملف PDF واحد."""
-    image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".webp"}
-    try:
-        files = [p for p in folder.iterdir() if p.is_file() and p.suffix.lower() in image_extensions]
-    except PermissionError:
-        print("لا صلاحيات للوصول إلى هذا المجلد. امنح الصلاحيات اللازمة من إعدادات الخصوصية في macOS.")
-        return
-    files.sort(key=lambda p: natural_key(p.name))
-    images = []
-    for f in files:
-        try:
-            img = open_image_rgb_fixed(f)
-            images.append(img)
-        except Exception as e:
-            print(f"فشل تحميل الصورة {f.name} للدمج: {e}")
-            continue
-    
-    if not images:
-        print("لا توجد صور صالحة للدمج.")
+    """يدمج جميع ملفات الصور في المجلد إلى ملف PDF واحد، صورةً صورة دون تحميلها كلها في الذاكرة."""
+    files = _list_images(folder)
+    if files is None:
         return
-    
     out_path = folder / out_name
     try:
-        # حفظ الصورة الأولى، ثم إضافة البقية
-        images[0].save(out_path, save_all=True, append_images=images[1:], resolution=300)
-        print(f"تم دمج {len(images)} صورة في ملف واحد: {out_path.name}")
+        count = _merge_images_streaming(files, out_path)
     except Exception as e:
         print(f"فشل دمج الصور إلى PDF: {e}")
-    finally:
-        for im in images:
-            im.close() # تأكد من إغلاق جميع كائنات الصور
+        return
+    if not count:
+        try:
+            out_path.unlink()
+        except OSError:
+            pass
+        print("لا توجد صور صالحة للدمج.")
+        return
+    print(f"تم دمج {count} صورة في ملف واحد: {out_path.name}")
 
 # ===================== دوال تشغيل الخدمة =====================
 
@@ -876,6 +3284,52 @@ def run_extract_images_from_first_pdf(directory: Path):
     else:
         print("لم يتم العثور على صور مضمّنة في الملف الأول.")
 
+def run_dedupe_searchable_pdfs(directory: Path):
+    """يزيل الموارد المكررة من كل ملفات قابل_للبحث في المجلد لتقليل حجمها."""
+    pdfs = [p for p in list_pdfs(directory) if p.stem.endswith("-قابل_للبحث")]
+    if not pdfs:
+        print("لا توجد ملفات قابل_للبحث في المجلد الحالي.")
+        return
+    answer = input(f"ستُعاد كتابة {len(pdfs)} ملفًا قابلًا للبحث في مكانها. متابعة؟ (نعم/لا): ").strip()
+    if answer not in ("نعم", "ن", "y", "yes"):
+        print("أُلغيت العملية.")
+        return
+    saved = 0
+    for pdf in pdfs:
+        try:
+            before = pdf.stat().st_size
+            _, shared = dedupe_pdf_resources(pdf)
+            after = pdf.stat().st_size
+            saved += before - after
+            print(f"{pdf.name}: شوركت {shared} موارد، الحجم {before // 1024} ك.ب -> {after // 1024} ك.ب")
+        except Exception as e:
+            print(f"تعذر تقليص {pdf.name}: {e}")
+    print(f"اكتملت العملية. المساحة الموفّرة: {saved // 1024} ك.ب")
+
+def run_search_library(directory: Path):
+    """يبحث في نصوص الكتب المفهرسة ويعرض الكتاب والصفحة ومواضع الكلمات لكل نتيجة (بعد تحديث الفهرس تزايديًا)."""
+    if not index_library(directory):
+        print("لا توجد ملفات نصية للفهرسة في المجلد الحالي.")
+        return
+    while True:
+        query = input("أدخل كلمات البحث (سطر فارغ للعودة): ").strip()
+        if not query:
+            return
+        start = time.perf_counter()
+        hits = search_with_boxes(directory, query)
+        elapsed = (time.perf_counter() - start) * 1000
+        if not hits:
+            print(f"لا نتائج ({elapsed:.1f} م.ث).")
+            continue
+        pages: dict = {}
+        for name, page, box in hits:
+            pages.setdefault((name, page), []).append(box)
+        print(f"{len(pages)} صفحة ({elapsed:.1f} م.ث):")
+        for (name, page), boxes in pages.items():
+            located = [b for b in boxes if b]
+            where = f" — {len(located)} موضع، أولها {located[0]}" if located else ""
+            print(f"  {name} — صفحة {page}{where}")
+
 def run_rotate_pages(directory: Path):
     """يدوّر صفحات محددة بزوايا 0/90/180/270 من أول ملف PDF."""
     try:
@@ -940,6 +3394,8 @@ def main():
         "11) تدوير صفحات من أول ملف مصور\n"
         "12) إعادة ترتيب صفحات أول ملف مصور (أ-ي / ي-أ)\n"
         "13) إنهاء البرنامج\n"
+        "14) إزالة الموارد المكررة من الكتب القابلة للبحث\n"
+        "15) البحث في نصوص الكتب\n"
         "إدخال: "
     )
 
@@ -978,6 +3434,10 @@ def main():
             elif choice == "13":
                 print("تم الإنهاء.")
                 break
+            elif choice == "14":
+                run_dedupe_searchable_pdfs(base_dir)
+            elif choice == "15":
+                run_search_library(base_dir)
             else:
                 print("خيار غير صحيح.")
         except Exception: